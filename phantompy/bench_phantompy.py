@@ -0,0 +1,370 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+An offline benchmark of the render pipeline.
+
+Serves deterministic fixture pages from a local http.server:
+  static   a small static page
+  js       a page that builds its content with javascript
+  large    a page with a large DOM
+  many     a page with many small subresources
+  resolve  a stand-in for https://dns.google/resolve for LookFor
+and drives Render (load, JS, HTML save and PDF print) and LookFor
+through them, reporting pages/sec, p50/p95/p99 latency per stage,
+the peak RSS of Python and of the QtWebEngine processes, and the
+startup time, split into the command line imports, the Qt imports, the
+application, the profile, the first page and a warm page, with the time
+of --help, as JSON that can be compared across versions:
+
+    python3 bench_phantompy.py --runs 20 --json_output bench.json
+
+The startup time is measured in a fresh process with --startup.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from support_phantompy import ipid_rss_kb
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+lKINDS = ['static', 'js', 'large', 'many', 'resolve']
+
+def spage(skind):
+    """Return the fixture page for skind: the same bytes every time."""
+    if skind == 'static':
+        return "<html><head><title>static</title></head><body>" + \
+            "".join(f"<p>paragraph {i}</p>" for i in range(50)) + "</body></html>"
+    if skind == 'js':
+        return """<html><head><title>js</title></head><body><div id="out"></div>
+<script>
+var out = document.getElementById('out');
+for (var i = 0; i < 2000; i++) {
+  var d = document.createElement('div');
+  var x = 0;
+  for (var j = 0; j < 500; j++) { x += Math.sqrt(i * j); }
+  d.textContent = 'row ' + i + ' ' + x.toFixed(2);
+  out.appendChild(d);
+}
+</script></body></html>"""
+    if skind == 'large':
+        return "<html><head><title>large</title></head><body><table>" + \
+            "".join(f"<tr><td>{i}</td><td>cell {i}</td><td><a href='#{i}'>link</a></td></tr>"
+                    for i in range(20000)) + "</table></body></html>"
+    if skind == 'many':
+        return "<html><head><title>many</title>" + \
+            "".join(f"<link rel='stylesheet' href='/res/{i}.css'>" for i in range(50)) + \
+            "</head><body>" + \
+            "".join(f"<img src='/res/{i}.svg'>" for i in range(50)) + "</body></html>"
+    raise ValueError(skind)
+
+def dresolve(sname):
+    """Return the stand-in dns.google answer for the TXT record sname:
+    names starting with bad have the wrong record, with nx none at all,
+    and with malformed a record without its data."""
+    d = {"Status": 0, "TC": False, "RD": True, "RA": True, "AD": False, "CD": True,
+         "Question": [{"name": sname + '.', "type": 16}]}
+    if sname.startswith('nx'):
+        d["Status"] = 3
+        d["Authority"] = [{"name": sname + '.', "type": 6, "TTL": 60, "data": "ns. hostmaster. 1 2 3 4 5"}]
+        return d
+    if sname.startswith('malformed'):
+        d["Answer"] = [{"name": sname + '.', "type": 16, "TTL": 300}]
+        return d
+    sdata = 'we-run-this-tor-relay' if not sname.startswith('bad') else 'no'
+    d["Answer"] = [{"name": sname + '.', "type": 16, "TTL": 300, "data": sdata}]
+    return d
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # keep-alive, like a real server
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, sdata, stype):
+        bdata = sdata.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', stype)
+        self.send_header('Content-Length', str(len(bdata)))
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(bdata)
+
+    def do_GET(self):
+        o = urlparse(self.path)
+        if o.path == '/resolve':
+            sname = parse_qs(o.query).get('name', [''])[0]
+            return self._reply(json.dumps(dresolve(sname)), 'application/json')
+        if o.path.startswith('/res/') and o.path.endswith('.css'):
+            return self._reply("p { margin: 1px; }", 'text/css')
+        if o.path.startswith('/res/') and o.path.endswith('.svg'):
+            return self._reply("<svg xmlns='http://www.w3.org/2000/svg' width='8' height='8'/>",
+                               'image/svg+xml')
+        skind = o.path.strip('/').replace('.html', '')
+        if skind in lKINDS and skind != 'resolve':
+            return self._reply(spage(skind), 'text/html')
+        self.send_error(404)
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def ostart_fixture_server(shost='127.0.0.1', iport=0):
+    """Start the fixture server in a thread and return it;
+    its base url is server.sbase."""
+    server = FixtureServer((shost, iport), FixtureHandler)
+    server.sbase = f"http://{shost}:{server.server_address[1]}"
+    othread = threading.Thread(target=server.serve_forever, daemon=True)
+    othread.start()
+    return server
+
+def dpercentiles(lvals, lps=(50, 95, 99)):
+    """Return {pN: value} of lvals by the nearest rank method."""
+    if not lvals:
+        return {}
+    lvals = sorted(lvals)
+    d = {}
+    for ip in lps:
+        i = max(0, min(len(lvals) - 1, math.ceil(ip / 100.0 * len(lvals)) - 1))
+        d[f"p{ip}"] = lvals[i]
+    return d
+
+def lwebengine_pids(iparent=None):
+    """Return the pids of the QtWebEngineProcess descendants of iparent."""
+    iparent = iparent or os.getpid()
+    dchildren = {}
+    lweb = []
+    if not os.path.isdir('/proc'):
+        return lweb
+    for sdir in os.listdir('/proc'):
+        if not sdir.isdigit(): continue
+        try:
+            with open(f"/proc/{sdir}/stat", 'rt') as ifd:
+                lelts = ifd.read().rsplit(')', 1)[1].split()
+            with open(f"/proc/{sdir}/comm", 'rt') as ifd:
+                scomm = ifd.read().strip()
+        except (OSError, IndexError):
+            continue
+        dchildren.setdefault(int(lelts[1]), []).append((int(sdir), scomm))
+    ltodo = [iparent]
+    while ltodo:
+        for ipid, scomm in dchildren.get(ltodo.pop(), []):
+            ltodo.append(ipid)
+            if scomm.startswith('QtWebEngine'):
+                lweb.append(ipid)
+    return lweb
+
+class RssSampler:
+    """Samples the RSS of the QtWebEngine processes to find the peak."""
+
+    def __init__(self):
+        self.ipeak_webengine_kb = 0
+
+    def sample(self):
+        itotal = sum(ipid_rss_kb(ipid) for ipid in lwebengine_pids())
+        self.ipeak_webengine_kb = max(self.ipeak_webengine_kb, itotal)
+        return itotal
+
+    async def run(self, finterval=0.25):
+        while True:
+            self.sample()
+            await asyncio.sleep(finterval)
+
+def dstages(lresults):
+    """Return the latency percentiles in seconds of each stage of lresults,
+    where a stage is the time from the previous timing to its own,
+    and start is the wait for a page."""
+    dvals = {}
+    for result in lresults:
+        lkeys = sorted(result.timings.items(), key=lambda elt: elt[1])
+        prev = 0.0
+        for skey, fval in lkeys:
+            dvals.setdefault(skey, []).append(fval - prev)
+            prev = fval
+        if 'exit' in result.timings:
+            dvals.setdefault('total', []).append(result.timings['exit'])
+    return {skey: dpercentiles(lvals) for skey, lvals in dvals.items()}
+
+async def abench(app, sbase, lkinds, iruns=10, iconcurrency=4, sdir='/tmp'):
+    """Render each of lkinds iruns times and return the report dict."""
+    from lookupdns import LookFor
+    from pool_phantompy import RenderPool
+    from qasync_phantompy import render
+
+    sampler = RssSampler()
+    osample = asyncio.ensure_future(sampler.run())
+    dreport = {}
+    try:
+        for skind in lkinds:
+            if skind == 'resolve':
+                pool = RenderPool(app, isize=iconcurrency, klass=LookFor)
+                ljobs = [(f"{sbase}/resolve?name={i:040d}.fp.example&type=TXT",
+                          dict(html=os.path.join(sdir, f"resolve-{i}.html")))
+                         for i in range(iruns)]
+            else:
+                pool = RenderPool(app, isize=iconcurrency)
+                # outputs of their own, so that concurrent writes do not
+                # race on one file and the sizes are those of the run
+                ljobs = [(f"{sbase}/{skind}.html?run={i}",
+                          dict(html=os.path.join(sdir, f"{skind}-{i}.html"),
+                               pdf=os.path.join(sdir, f"{skind}-{i}.pdf"),
+                               dready=dict(smode='load')))
+                         for i in range(iruns)]
+            pool.warm()
+            t0 = time.monotonic()
+            lresults = await asyncio.gather(*[render(url, app=app, pool=pool, **dkw)
+                                              for url, dkw in ljobs])
+            felapsed = time.monotonic() - t0
+            pool.close()
+            iok = len([elt for elt in lresults if elt.status == 'ok'])
+            dreport[skind] = dict(runs=iruns, ok=iok,
+                                  seconds=felapsed,
+                                  pages_per_sec=iok / felapsed if felapsed else 0,
+                                  stages=dstages(lresults))
+            LOG.info(f"bench: {skind} {iok}/{iruns} in {felapsed:.2f}s")
+    finally:
+        osample.cancel()
+    dreport['peak_rss_kb'] = dict(
+        python=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        webengine=sampler.ipeak_webengine_kb)
+    return dreport
+
+def dstartup(sbase):
+    """In this fresh process, time separately the imports of the command
+    line, the Qt imports, the QApplication, the profile, the first page
+    and a warm page (the next one, on the same page of a pool), and
+    return them in seconds."""
+    t0 = time.monotonic()
+    from qasync_phantompy import oqapp, render
+    from support_phantompy import omain_argparser
+    omain_argparser()
+    t1 = time.monotonic()
+    from qasync import QEventLoop
+
+    import phantompy  # noqa
+    from pool_phantompy import RenderPool
+    from profile_phantompy import oprofile
+    t2 = time.monotonic()
+    app = oqapp()
+    loop = QEventLoop(app)
+    asyncio.set_event_loop(loop)
+    t3 = time.monotonic()
+    oprofile()
+    t4 = time.monotonic()
+    pool = RenderPool(app, isize=1)
+    result = loop.run_until_complete(render(f"{sbase}/static.html", app=app,
+                                            pool=pool, dready=dict(smode='load')))
+    t5 = time.monotonic()
+    result = loop.run_until_complete(render(f"{sbase}/static.html?warm", app=app,
+                                            pool=pool, dready=dict(smode='load')))
+    t6 = time.monotonic()
+    pool.close()
+    return dict(imports_cli=t1 - t0, imports_qt=t2 - t1, app=t3 - t2,
+                profile=t4 - t3, first_page=t5 - t4, warm_page=t6 - t5,
+                total=t5 - t0, status=result.status)
+
+def dstartup_subprocess(sbase):
+    """Run dstartup in a fresh interpreter and return its dict."""
+    t0 = time.monotonic()
+    sout = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                    '--startup', '--base', sbase],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    d = json.loads(sout.decode('utf-8').strip().splitlines()[-1])
+    d['wall'] = time.monotonic() - t0
+    return d
+
+def fhelp_subprocess():
+    """Return the seconds qasync_phantompy.py --help takes in a fresh
+    interpreter, which should not import Qt at all."""
+    sdir = os.path.dirname(os.path.abspath(__file__))
+    t0 = time.monotonic()
+    subprocess.check_call([sys.executable, os.path.join(sdir, 'qasync_phantompy.py'),
+                           '--help'], cwd=sdir, stdout=subprocess.DEVNULL)
+    return time.monotonic() - t0
+
+def obench_argparser():
+    parser = argparse.ArgumentParser(add_help=True, description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10,
+                        help="Renders of each kind of page")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Pages rendered at once")
+    parser.add_argument('--kinds', type=str, default=','.join(lKINDS),
+                        help="Comma separated kinds of page to render")
+    parser.add_argument('--label', type=str, default='',
+                        help="A label for the report, e.g. the version")
+    parser.add_argument('--json_output', type=str, default='',
+                        help="Write the report to this file as well as stdout")
+    parser.add_argument('--log_level', type=int, default=20,
+                        help="10=debug 20=info 30=warn 40=error")
+    parser.add_argument('--startup', default=False, action='store_true',
+                        help="Only time the startup in this process (internal)")
+    parser.add_argument('--base', type=str, default='',
+                        help="Base url of a running fixture server")
+    return parser
+
+def iMain(largs):
+    parser = obench_argparser()
+    oargs = parser.parse_args(largs)
+    from support_phantompy import vsetup_logging
+    vsetup_logging(oargs.log_level, logfile='', stream=sys.stderr)
+
+    server = None
+    sbase = oargs.base
+    if not sbase:
+        server = ostart_fixture_server()
+        sbase = server.sbase
+
+    if oargs.startup:
+        print(json.dumps(dstartup(sbase)))
+        return 0
+
+    dreport = dict(label=oargs.label,
+                   python=platform.python_version(),
+                   platform=platform.platform(),
+                   runs=oargs.runs,
+                   concurrency=oargs.concurrency)
+    dreport['startup'] = dstartup_subprocess(sbase)
+    dreport['startup']['help'] = fhelp_subprocess()
+
+    from qasync import QEventLoop
+
+    from qasync_phantompy import oqapp
+    app = oqapp()
+    loop = QEventLoop(app)
+    asyncio.set_event_loop(loop)
+    lkinds = [elt for elt in oargs.kinds.split(',') if elt]
+    with tempfile.TemporaryDirectory() as sdir:
+        dreport['kinds'] = loop.run_until_complete(
+            abench(app, sbase, lkinds, oargs.runs, oargs.concurrency, sdir))
+    if server is not None:
+        server.shutdown()
+
+    sjson = json.dumps(dreport, indent=2, sort_keys=True)
+    print(sjson)
+    if oargs.json_output:
+        with open(oargs.json_output, 'wt') as ofd:
+            ofd.write(sjson + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(iMain(sys.argv[1:]))
@@ -0,0 +1,136 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+A QWebChannel bridge from the page to its Render, so that page scripts
+can say they are done, with data, without going through console.log:
+
+    phantompy_done({"title": document.title});
+
+phantompy_done is defined at document creation and queues the call until
+the channel is connected. Its argument is JSON serialized and ends up as
+the data of the RenderResult. console.log("__PHANTOM_PY_DONE__") still
+works for old scripts: the bridge turns it into a phantompy_done(null).
+
+Each document is stamped, by vstamp_job, with the job of the page it was
+made for, and the stamp goes with its payload, so that a late done from
+the document of an earlier job, or of a blank page, is dropped instead
+of ending the next job on a reused page.
+"""
+
+import importlib
+import json
+
+from qasync import QtModuleName
+
+QWebChannel = importlib.import_module(QtModuleName + ".QtWebChannel", package=QtModuleName).QWebChannel
+try:
+    QWebEngineScript = importlib.import_module(QtModuleName + ".QtWebEngineCore", package=QtModuleName).QWebEngineScript
+except (ImportError, AttributeError):
+    QWebEngineScript = importlib.import_module(QtModuleName + ".QtWebEngineWidgets", package=QtModuleName).QWebEngineScript
+QtCore = importlib.import_module(QtModuleName + ".QtCore", package=QtModuleName)
+QFile, QIODevice, QObject = QtCore.QFile, QtCore.QIODevice, QtCore.QObject
+Slot = getattr(QtCore, 'Slot', None) or getattr(QtCore, 'pyqtSlot')
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+BRIDGE_JS = """
+(function() {
+  var queue = [], bridge = null;
+  window.phantompy_done = function(data) {
+    var payload = JSON.stringify({job: window.phantompy_job || 0,
+                                  data: data === undefined ? null : data});
+    if (bridge) { bridge.done(payload); } else { queue.push(payload); }
+  };
+  // the magic string of old scripts, so that it is stamped too
+  ['log', 'info', 'warn', 'error'].forEach(function(level) {
+    var _log = console[level];
+    console[level] = function() {
+      if (Array.prototype.join.call(arguments, ' ').indexOf('__PHANTOM_PY_DONE__') >= 0) {
+        window.phantompy_done(null);
+      }
+      return _log.apply(console, arguments);
+    };
+  });
+  // from phantompy_done in the isolated world, see scripts_phantompy
+  document.addEventListener('phantompy_done', function() {
+    var root = document.documentElement;
+    var payload = root.getAttribute('data-phantompy-done');
+    root.removeAttribute('data-phantompy-done');
+    window.phantompy_done(payload === null ? null : JSON.parse(payload));
+  });
+  new QWebChannel(qt.webChannelTransport, function(channel) {
+    bridge = channel.objects.phantompy;
+    while (queue.length) { bridge.done(queue.shift()); }
+  });
+})();
+"""
+
+_sQWEBCHANNEL_JS = None
+
+def sqwebchannel_js():
+    """Return the contents of qwebchannel.js from the Qt resources, once."""
+    global _sQWEBCHANNEL_JS
+    if _sQWEBCHANNEL_JS is None:
+        ofile = QFile(':/qtwebchannel/qwebchannel.js')
+        if not ofile.open(QIODevice.ReadOnly):
+            LOG.error("bridge: can not read qwebchannel.js")
+            _sQWEBCHANNEL_JS = ''
+        else:
+            _sQWEBCHANNEL_JS = bytes(ofile.readAll()).decode('utf-8')
+            ofile.close()
+    return _sQWEBCHANNEL_JS
+
+class Bridge(QObject):
+    """The object registered as phantompy in the page's QWebChannel."""
+
+    def __init__(self, render):
+        QObject.__init__(self)
+        self._render = render
+
+    @Slot(str)
+    def done(self, payload):
+        try:
+            d = json.loads(payload)
+            ijob, data = int(d['job']), d['data']
+        except (ValueError, KeyError, TypeError) as e:
+            LOG.warn(f"bridge: bad payload from {self._render.uri} {e}")
+            return
+        if ijob != self._render.ijobs:
+            LOG.debug(f"bridge: dropped a done of job {ijob} in job {self._render.ijobs}")
+            return
+        self._render._done(0, data)
+
+def vinstall_bridge(render):
+    """Attach a Bridge to the page render and inject phantompy_done."""
+    render._bridge = Bridge(render)
+    render._channel = QWebChannel(render)
+    render._channel.registerObject('phantompy', render._bridge)
+    render.setWebChannel(render._channel)
+    oscript = QWebEngineScript()
+    oscript.setName('phantompy_bridge')
+    oscript.setSourceCode(sqwebchannel_js() + BRIDGE_JS)
+    oscript.setInjectionPoint(QWebEngineScript.DocumentCreation)
+    oscript.setWorldId(QWebEngineScript.MainWorld)
+    oscript.setRunsOnSubFrames(False)
+    render.scripts().insert(oscript)
+    render._ostamp = None
+
+def vstamp_job(render, ijob):
+    """Stamp the documents that the page render makes from now on with
+    the job ijob, 0 for none."""
+    if render._ostamp is not None:
+        render.scripts().remove(render._ostamp)
+    oscript = QWebEngineScript()
+    oscript.setName('phantompy_job')
+    oscript.setSourceCode(f"window.phantompy_job = {int(ijob)};")
+    oscript.setInjectionPoint(QWebEngineScript.DocumentCreation)
+    oscript.setWorldId(QWebEngineScript.MainWorld)
+    oscript.setRunsOnSubFrames(False)
+    render.scripts().insert(oscript)
+    render._ostamp = oscript
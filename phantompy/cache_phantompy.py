@@ -0,0 +1,209 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+An on disk cache of render results, so that rendering the same url with
+the same javascript and outputs again just copies the saved outputs.
+
+The key is a hash of the normalized url, a hash of the javascript and
+the output options. Each entry is a directory holding meta.json and the
+html and pdf outputs. Entries older than ittl seconds are misses, and
+when the cache grows over isize bytes the least recently used entries
+are removed. Identical jobs that start while one is rendering wait for
+it instead of rendering again, and render themselves if its outputs
+could not be kept.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+class RenderCache:
+
+    def __init__(self, sdir, ittl=3600, isize=512*1024*1024):
+        self.sdir = sdir
+        self.ittl = ittl
+        self.isize = isize
+        # skey -> [used, size]
+        self._dindex = {}
+        # skey -> dict of the Render rendering it (owner) and its job
+        # (ijob), and the (Render, job) waiting for it (lwaiting)
+        self._dinflight = {}
+        self.ihits = 0
+        self.imisses = 0
+        self.ijoined = 0
+        os.makedirs(sdir, exist_ok=True)
+        self._vload_index()
+
+    def _sentry(self, skey):
+        return os.path.join(self.sdir, skey[:2], skey)
+
+    def _vload_index(self):
+        for sub in os.listdir(self.sdir):
+            sub = os.path.join(self.sdir, sub)
+            if not os.path.isdir(sub): continue
+            for skey in os.listdir(sub):
+                smeta = os.path.join(sub, skey, 'meta.json')
+                try:
+                    with open(smeta, 'rt') as ifd:
+                        meta = json.load(ifd)
+                    self._dindex[skey] = [meta['used'], meta['size']]
+                except (OSError, ValueError, KeyError):
+                    shutil.rmtree(os.path.join(sub, skey), ignore_errors=True)
+        LOG.debug(f"cache: {len(self._dindex)} entries in {self.sdir}")
+
+    def skey(self, url, js_contents, doptions):
+        """Return the key for url run with js_contents and doptions."""
+        # imported here so that the cache can be used without Qt
+        from qasync import QtCore
+        QUrl = QtCore.QUrl
+        surl = QUrl.fromUserInput(url).adjusted(QUrl.NormalizePathSegments).toString()
+        sjs = hashlib.sha256((js_contents or '').encode('utf-8')).hexdigest()
+        sopts = json.dumps(doptions, sort_keys=True, default=str)
+        return hashlib.sha256('\n'.join([surl, sjs, sopts]).encode('utf-8')).hexdigest()
+
+    def dget(self, skey):
+        """Return the meta dict of a live entry for skey, or None."""
+        if skey not in self._dindex:
+            return None
+        sentry = self._sentry(skey)
+        try:
+            with open(os.path.join(sentry, 'meta.json'), 'rt') as ifd:
+                meta = json.load(ifd)
+        except (OSError, ValueError):
+            self._vremove(skey)
+            return None
+        if time.time() - meta['created'] > self.ittl:
+            LOG.debug(f"cache: expired {meta['uri']}")
+            self._vremove(skey)
+            return None
+        for sfile in meta['files'].values():
+            if not os.path.exists(os.path.join(sentry, sfile)):
+                self._vremove(skey)
+                return None
+        meta['used'] = time.time()
+        self._dindex[skey][0] = meta['used']
+        try:
+            self._vwrite_meta(sentry, meta)
+        except OSError as e:
+            # only the last used time is lost
+            LOG.debug(f"cache: can not touch {meta['uri']} {e}")
+        return meta
+
+    def sfile(self, skey, meta, skind):
+        """Return the path of the cached output skind (html or pdf)."""
+        return os.path.join(self._sentry(skey), meta['files'][skind])
+
+    def _vwrite_meta(self, sentry, meta):
+        stmp = os.path.join(sentry, 'meta.json.tmp')
+        with open(stmp, 'wt') as ofd:
+            json.dump(meta, ofd)
+        os.replace(stmp, os.path.join(sentry, 'meta.json'))
+
+    def _vremove(self, skey):
+        self._dindex.pop(skey, None)
+        shutil.rmtree(self._sentry(skey), ignore_errors=True)
+
+    def vput(self, skey, uri, doutputs, data=None):
+        """Store copies of the output files doutputs {kind: path} for skey."""
+        sentry = self._sentry(skey)
+        os.makedirs(sentry, exist_ok=True)
+        dfiles = {}
+        isize = 0
+        for skind, spath in doutputs.items():
+            if not spath or not os.path.exists(spath): continue
+            shutil.copyfile(spath, os.path.join(sentry, skind))
+            dfiles[skind] = skind
+            isize += os.path.getsize(spath)
+        now = time.time()
+        meta = dict(uri=uri, created=now, used=now, size=isize,
+                    files=dfiles, data=data)
+        self._vwrite_meta(sentry, meta)
+        self._dindex[skey] = [now, isize]
+        self.vevict()
+
+    def vevict(self):
+        """Remove the least recently used entries until under isize."""
+        itotal = sum(elt[1] for elt in self._dindex.values())
+        if itotal <= self.isize:
+            return
+        for skey, (used, isize) in sorted(self._dindex.items(), key=lambda elt: elt[1][0]):
+            if itotal <= self.isize: break
+            self._vremove(skey)
+            itotal -= isize
+            LOG.debug(f"cache: evicted {skey}")
+
+    def bjoin(self, skey, r):
+        """Called from Render.run: return True if r has been answered from
+        the cache or will be by the Render already doing skey, or False if
+        r should render it, after which it must call vleave."""
+        meta = self.dget(skey)
+        if meta is not None:
+            self.ihits += 1
+            r._cached(skey, meta)
+            return True
+        if skey in self._dinflight:
+            self.ijoined += 1
+            # the job number tells if r has since been reset and reused
+            self._dinflight[skey]['lwaiting'].append((r, r.ijobs))
+            return True
+        self.imisses += 1
+        self._dinflight[skey] = dict(owner=r, ijob=r.ijobs, lwaiting=[])
+        return False
+
+    def vleave(self, skey, r, val):
+        """Called from Render._exit and Render.reset of r with the job of
+        skey: if r is rendering skey, finish it with val, else r stops
+        waiting for it."""
+        dflight = self._dinflight.get(skey)
+        if dflight is None:
+            return
+        if dflight['owner'] is r and dflight['ijob'] == r.ijobs:
+            self.vfinish(skey, r, val)
+            return
+        dflight['lwaiting'] = [elt for elt in dflight['lwaiting'] if elt[0] is not r]
+
+    def vfinish(self, skey, r, val):
+        """End the rendering of skey by r with val, storing its outputs if
+        it is ok, and answer the Renders waiting for it."""
+        dflight = self._dinflight.pop(skey, None)
+        lwaiting = dflight['lwaiting'] if dflight else []
+        meta = None
+        if val == 0:
+            try:
+                self.vput(skey, r.uri, r.oresult(val).outputs, r.data)
+                meta = self.dget(skey)
+            except OSError as e:
+                LOG.warn(f"cache: can not store {r.uri} {e}")
+        for elt, ijob in lwaiting:
+            if elt.uri is None or elt.ijobs != ijob:
+                continue
+            try:
+                if meta is not None:
+                    elt._cached(skey, meta)
+                elif val == 0:
+                    # rendered, but not stored or evicted at once for being
+                    # bigger than the cache: render it for this job too
+                    elt._vload()
+                else:
+                    elt._exit(val)
+            except Exception as e:
+                # one waiter must not stop the others being answered
+                LOG.exception(f"cache: answering {elt.uri} {e}")
+                elt._exit(1, status='error')
+
+    def dstats(self):
+        return dict(entries=len(self._dindex),
+                    bytes=sum(elt[1] for elt in self._dindex.values()),
+                    hits=self.ihits,
+                    misses=self.imisses,
+                    joined=self.ijoined)
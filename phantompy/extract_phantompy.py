@@ -0,0 +1,114 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+Extraction: run an extractor in the page when it is ready and hand back
+only its JSON serializable result, through phantompy_done, instead of
+saving the DOM.
+
+The extractor is javascript, a function of the document whose result,
+or the value of the Promise it returns, is the data:
+
+    function(document) { return {title: document.title}; }
+
+or a JSON map of names to CSS selectors:
+
+    {"title": "h1", "links": ["a@href"], "image": "meta[property='og:image']@content"}
+
+where a selector gives the trimmed text of the first element it matches
+or null, selector@attribute its attribute, and a list of one selector
+the same for all the elements it matches.
+
+The data of the result is {"extract": ..., "ready": ...}, or
+{"error": ...} if the extractor threw; sndjson makes the line that is
+written for each url.
+"""
+
+import json
+import os
+
+from ready_phantompy import sready_js
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+SELECTORS_JS = """
+function(document) {
+  var map = %s;
+  function one(el, attr) {
+    if (el === null) return null;
+    if (attr) return el.getAttribute(attr);
+    return (el.textContent || '').trim();
+  }
+  function parse(s) {
+    var i = s.lastIndexOf('@');
+    return i < 0 ? [s, ''] : [s.slice(0, i), s.slice(i + 1)];
+  }
+  var out = {};
+  Object.keys(map).forEach(function(name) {
+    var spec = map[name];
+    if (Array.isArray(spec)) {
+      var p = parse(spec[0]);
+      out[name] = Array.prototype.map.call(document.querySelectorAll(p[0]),
+        function(el) { return one(el, p[1]); });
+    } else {
+      var p = parse(spec);
+      out[name] = one(document.querySelector(p[0]), p[1]);
+    }
+  });
+  return out;
+}
+"""
+
+# the ready javascript hands over to phantompy_extract when it is defined
+EXTRACT_JS = """
+(function(extractor) {
+  window.phantompy_extract = function(why) {
+    Promise.resolve().then(function() { return extractor(document); }).then(
+      function(value) { phantompy_done({extract: value === undefined ? null : value,
+                                        ready: why}); },
+      function(e) { phantompy_done({error: String(e && e.message || e),
+                                    ready: why}); });
+  };
+})(%s);
+"""
+
+def sextractor_js(sextract):
+    """Return the javascript function of sextract, a file or the text of
+    a javascript function or of a JSON map of names to selectors."""
+    if os.path.isfile(sextract):
+        with open(sextract, 'rt') as ifd:
+            sextract = ifd.read()
+    sextract = sextract.strip()
+    if not sextract.startswith('{'):
+        return sextract
+    try:
+        dmap = json.loads(sextract)
+    except ValueError as e:
+        raise ValueError(f"extract: the selector map is not JSON {e}")
+    for key, elt in dmap.items():
+        if isinstance(elt, list) and len(elt) == 1:
+            elt = elt[0]
+        if not isinstance(elt, str) or not elt:
+            raise ValueError(f"extract: {key} is not a selector or a list of one")
+    return SELECTORS_JS % json.dumps(dmap)
+
+def sextract_js(sextract, dready=None):
+    """Return the javascript of a job that waits for the page to be ready
+    as sready_js does with dready, then runs the extractor sextract; it
+    runs at document creation in the main world."""
+    return EXTRACT_JS % sextractor_js(sextract) + sready_js(**(dready or {}))
+
+def sndjson(dresult):
+    """Return the NDJSON line for the RenderResult dict dresult."""
+    data = dresult.get('data')
+    d = dict(uri=dresult['uri'], status=dresult['status'])
+    if isinstance(data, dict) and 'error' in data:
+        d['status'] = 'error'
+        d['error'] = data['error']
+    d['data'] = data.get('extract') if isinstance(data, dict) else None
+    return json.dumps(d, default=str)
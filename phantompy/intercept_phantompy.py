@@ -0,0 +1,132 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+Request interception for Render pages: block the subresources a job does
+not need, by named profile and by url patterns, and count what was blocked.
+
+Profiles:
+  none             block nothing but the patterns
+  html-only        block everything that is not the document, frames,
+                   scripts or XHR: images, stylesheets, fonts, media...
+  no-media         block images, media, fonts and plugins
+  allowlist-hosts  block every host that is not the page's or allowed
+
+Patterns are globs on the whole url, e.g. *://*.doubleclick.net/*,
+or regular expressions if they start with re:
+"""
+
+import fnmatch
+import importlib
+import re
+
+from qasync import QtModuleName
+
+QtWebEngineCore = importlib.import_module(QtModuleName + ".QtWebEngineCore", package=QtModuleName)
+QWebEngineUrlRequestInterceptor = QtWebEngineCore.QWebEngineUrlRequestInterceptor
+QWebEngineUrlRequestInfo = QtWebEngineCore.QWebEngineUrlRequestInfo
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+lPROFILES = ['none', 'html-only', 'no-media', 'allowlist-hosts']
+
+def _lresource_types(lnames):
+    return [getattr(QWebEngineUrlRequestInfo, 'ResourceType' + elt)
+            for elt in lnames
+            if hasattr(QWebEngineUrlRequestInfo, 'ResourceType' + elt)]
+
+# the resource types blocked by each profile
+dBLOCKED_TYPES = {
+    'html-only': _lresource_types(['Image', 'Stylesheet', 'FontResource', 'Media',
+                                   'Object', 'Favicon', 'Ping', 'Prefetch',
+                                   'SubResource', 'CspReport', 'PluginResource',
+                                   'NavigationPreloadMainFrame',
+                                   'NavigationPreloadSubFrame']),
+    'no-media': _lresource_types(['Image', 'Media', 'FontResource', 'Object',
+                                  'Favicon', 'PluginResource']),
+}
+
+# resource type number -> short name, for the counts
+dTYPE_NAMES = {getattr(QWebEngineUrlRequestInfo, elt): elt[len('ResourceType'):].lower()
+               for elt in dir(QWebEngineUrlRequestInfo)
+               if elt.startswith('ResourceType') and elt != 'ResourceType'}
+
+def lcompile_patterns(lpatterns):
+    """Compile globs, or regexps prefixed by re:, to regexps."""
+    lregexps = []
+    for elt in lpatterns or []:
+        if elt.startswith('re:'):
+            lregexps.append(re.compile(elt[3:]))
+        else:
+            lregexps.append(re.compile(fnmatch.translate(elt)))
+    return lregexps
+
+class Interceptor(QWebEngineUrlRequestInterceptor):
+    """The request interceptor of one Render page, configured per job."""
+
+    def __init__(self, parent=None):
+        QWebEngineUrlRequestInterceptor.__init__(self, parent)
+        self.configure()
+
+    def configure(self, sprofile='none', lpatterns=None, lallow_hosts=None,
+                  spage_host=''):
+        """Set what to block for the next job, and zero the counts."""
+        if sprofile not in lPROFILES:
+            raise ValueError(f"unknown block profile {sprofile} not in {lPROFILES}")
+        self.sprofile = sprofile
+        self._sblocked_types = set(dBLOCKED_TYPES.get(sprofile, []))
+        self._lregexps = lcompile_patterns(lpatterns)
+        self._sallow_hosts = set(lallow_hosts or [])
+        if spage_host:
+            self._sallow_hosts.add(spage_host)
+        self.dblocked = {}
+        self.iallowed = 0
+
+    def _bhost_allowed(self, shost):
+        for elt in self._sallow_hosts:
+            if shost == elt or shost.endswith('.' + elt):
+                return True
+        return False
+
+    def interceptRequest(self, info):
+        itype = info.resourceType()
+        if itype == QWebEngineUrlRequestInfo.ResourceTypeMainFrame:
+            self.iallowed += 1
+            return
+        surl = info.requestUrl().toString()
+        bblock = itype in self._sblocked_types
+        if not bblock and self.sprofile == 'allowlist-hosts':
+            bblock = not self._bhost_allowed(info.requestUrl().host())
+        if not bblock and self._lregexps:
+            bblock = any(elt.match(surl) for elt in self._lregexps)
+        if bblock:
+            sname = dTYPE_NAMES.get(itype, str(itype))
+            self.dblocked[sname] = self.dblocked.get(sname, 0) + 1
+            info.block(True)
+        else:
+            self.iallowed += 1
+
+    def dcounts(self):
+        """Return the counts of this job: blocked by type, and allowed."""
+        return dict(blocked=dict(self.dblocked),
+                    blocked_total=sum(self.dblocked.values()),
+                    allowed=self.iallowed)
+
+def vinstall_interceptor(render):
+    """Give the page render its own Interceptor."""
+    render._interceptor = Interceptor(render)
+    if hasattr(render, 'setUrlRequestInterceptor'):
+        render.setUrlRequestInterceptor(render._interceptor)
+    else:
+        # before Qt 5.13 only profiles have interceptors
+        LOG.warn("intercept: no per page interceptors in this Qt, not blocking")
+
+def vconfigure_interceptor(render, spage_host, dintercept=None):
+    """Set the blocking of the page render for a job on spage_host:
+    dintercept are the keywords of Interceptor.configure."""
+    render._interceptor.configure(spage_host=spage_host, **(dintercept or {}))
@@ -0,0 +1,156 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+An append-only journal of a batch, so that a batch that dies partway
+through can be run again and pick up where it stopped.
+
+Each line is a JSON object. A start line is written when a job gets its
+slot and a finish line when it ends, with its status, output paths and
+their sizes and sha256:
+
+    {"event": "start", "uri": "https://a.example/", "time": 1700000000.0}
+    {"event": "finish", "uri": "https://a.example/", "status": "ok", "val": 0,
+     "outputs": {"html": "out/0.html"}, "sizes": {"html": 1234},
+     "sha256": {"html": "..."}, "retries": 0, "data": null, "time": 1700000001.5}
+
+Each line is flushed as it is written. Reading the journal back, the last
+finish of a url counts: it is done if that was ok and its outputs are
+still there with the sizes written. Failed jobs, and jobs that started
+but never finished, are run again. A torn last line from a crash is
+skipped. The data of a finish, what the page handed back, is kept so
+that an --extract batch can print the lines of the urls it skips.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+# bytes read at a time when hashing an output
+iCHUNK = 1024 * 1024
+
+def ssha256_file(sfile):
+    """Return the hex sha256 of the contents of sfile."""
+    h = hashlib.sha256()
+    with open(sfile, 'rb') as ifd:
+        for chunk in iter(lambda: ifd.read(iCHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def dhash_outputs(outputs):
+    """Return the sha256 of each of the outputs that exists: run it in a
+    thread, as the outputs can be big."""
+    dhashes = {}
+    for key, sfile in outputs.items():
+        try:
+            dhashes[key] = ssha256_file(sfile)
+        except OSError as e:
+            LOG.warn(f"journal: hashing {sfile} {e}")
+    return dhashes
+
+class Journal:
+
+    def __init__(self, sfile):
+        self.sfile = sfile
+        # uri -> the last finish line
+        self._dfinished = {}
+        # the uris started and not finished, as of the last run
+        self._lstarted = set()
+        self._vload()
+        sdir = os.path.dirname(sfile)
+        if sdir:
+            os.makedirs(sdir, exist_ok=True)
+        self._ofd = open(sfile, 'at', encoding='utf-8')
+        if self._btorn:
+            # so the next line does not run on from a torn one
+            self._ofd.write('\n')
+            self._ofd.flush()
+
+    def _vload(self):
+        self._btorn = False
+        if not os.path.exists(self.sfile):
+            return
+        ibad = 0
+        with open(self.sfile, 'rt', encoding='utf-8', errors='replace') as ifd:
+            for line in ifd:
+                self._btorn = not line.endswith('\n')
+                line = line.strip()
+                if not line: continue
+                try:
+                    d = json.loads(line)
+                    suri = d['uri']
+                    sevent = d['event']
+                except (ValueError, KeyError, TypeError):
+                    ibad += 1
+                    continue
+                if sevent == 'start':
+                    self._lstarted.add(suri)
+                elif sevent == 'finish':
+                    self._lstarted.discard(suri)
+                    self._dfinished[suri] = d
+        if ibad:
+            LOG.warn(f"journal: skipped {ibad} bad lines in {self.sfile}")
+        LOG.debug(f"journal: {len(self._dfinished)} finished and {len(self._lstarted)} unfinished in {self.sfile}")
+
+    def bdone(self, suri):
+        """True if suri finished ok and its outputs are as it left them."""
+        d = self._dfinished.get(suri)
+        if d is None or d.get('status') != 'ok':
+            return False
+        dsizes = d.get('sizes') or {}
+        for key, sfile in (d.get('outputs') or {}).items():
+            try:
+                isize = os.path.getsize(sfile)
+            except OSError:
+                return False
+            if key in dsizes and dsizes[key] != isize:
+                return False
+        return True
+
+    def dfinished(self, suri):
+        """Return the last finish dict of suri, or None."""
+        return self._dfinished.get(suri)
+
+    def lpending(self, ljobs):
+        """Return the jobs of ljobs, tuples of (url, ...), not done yet."""
+        lpending = [elt for elt in ljobs if not self.bdone(elt[0])]
+        idone = len(ljobs) - len(lpending)
+        if idone:
+            ifailed = len([elt for elt in lpending
+                           if elt[0] in self._dfinished or elt[0] in self._lstarted])
+            LOG.info(f"journal: skipping {idone} done, retrying {ifailed} failed or unfinished")
+        return lpending
+
+    def _vwrite(self, d):
+        self._ofd.write(json.dumps(d, default=str) + '\n')
+        # so a crash loses at most the line being written
+        self._ofd.flush()
+
+    def vstart(self, suri):
+        """Write that the job of suri has started."""
+        self._vwrite(dict(event='start', uri=suri, time=time.time()))
+
+    def vfinish(self, dresult, dhashes=None):
+        """Write that the job of the RenderResult dict dresult has ended,
+        with the sha256 of its outputs dhashes, see dhash_outputs."""
+        d = dict(event='finish', uri=dresult['uri'], status=dresult['status'],
+                 val=dresult.get('val'), outputs=dresult.get('outputs') or {},
+                 sizes=dresult.get('sizes') or {}, sha256=dhashes or {},
+                 retries=dresult.get('retries', 0), data=dresult.get('data'),
+                 time=time.time())
+        self._dfinished[d['uri']] = d
+        self._lstarted.discard(d['uri'])
+        self._vwrite(d)
+
+    def close(self):
+        if self._ofd is not None:
+            self._ofd.close()
+            self._ofd = None
@@ -0,0 +1,115 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+LookFor, the Render that lookupdns falls back to for resolver answers
+that are not plain JSON: it parses the record in the page with
+sEXTRACT_JS, and only if that fails scans the HTML from toHtml.
+
+It is in a module of its own so that lookupdns only imports Qt when an
+answer needs a browser; lookupdns.LookFor still finds it.
+"""
+
+import json
+import time
+
+from lookupdns import (ilookfor_json, ittl_json, sEXTRACT_JS, sfp_from_uri,
+                       verdict)
+from phantompy import Render
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+class LookFor(Render):
+  # _loadFinished runs sEXTRACT_JS itself
+  bjob_scripts = False
+
+  def __init__(self, app, do_print=True, do_save=False):
+    if not hasattr(app, 'lfps'):
+        app.lfps = []
+    self._app = app
+    self.do_print = do_print
+    self.do_save = do_save
+    self.progress = 0
+    self.we_run_this_tor_relay = None
+    # the result of ilookfor_record of the current job
+    self.ilook = None
+    Render.__init__(self, app, do_print, do_save)
+
+  def reset(self, do_print=True, do_save=False):
+    Render.reset(self, do_print, do_save)
+    self.we_run_this_tor_relay = None
+    self.ilook = None
+
+  def _exit(self, val, status=None):
+    if self.uri is None or self.percent >= 100: return
+    Render._exit(self, val, status)
+    self.percent = 100
+    LOG.debug(f"phantom.py: Exiting with val {val}")
+    # threadsafe?
+    self._app.lfps.append(sfp_from_uri(self.uri))
+
+  def _html_callback(self, *args):
+    """toHtml(self, Callable[[str], None])"""
+    if type(args[0]) is str:
+        i = self.ilook
+        if i is None:
+            i = self.ilookfor(args[0])
+        if self.htmlfile:
+            # _saved once the html is written
+            self._save(args[0], lambda val: self._saved(i))
+            return
+        self._saved(i)
+
+  def _json_callback(self, o):
+    """The record parsed in the page by sEXTRACT_JS, or None."""
+    if o is None:
+        LOG.debug(f"phantom.py: no JSON record in the page {self.uri}")
+        self.ilook = None
+        self.toHtml(self._html_callback)
+        return
+    self.ilook = self.ilookfor_record(o)
+    if self.do_save and self.htmlfile:
+        self.toHtml(self._html_callback)
+        return
+    self._saved(self.ilook)
+
+  def ilookfor_record(self, o):
+      i = ilookfor_json(o, self.uri)
+      if i != 1:
+          self.we_run_this_tor_relay = i == 0
+      # the result data
+      self.data = dict(verdict=verdict(i), ttl=ittl_json(o))
+      return i
+
+  def ilookfor(self, html):
+      marker = '<pre style="word-wrap: break-word; white-space: pre-wrap;">'
+      if marker not in html: return -1
+      i = html.find(marker) + len(marker)
+      html = html[i:]
+      i = html.find('</pre')
+      html = html[:i]
+      LOG.debug(f"Found {len(html)} json")
+      try:
+          o = json.loads(html)
+      except ValueError:
+          LOG.warn(f"FAIL no JSON in the page {self.uri}")
+          return 1
+      return self.ilookfor_record(o)
+
+  def _loadFinished(self, result):
+      if self._bstale_load(): return
+      if self.uri is None or self.percent >= 100: return
+      if not result:
+          LOG.warn(f"phantom.py: loading failed {self.uri}")
+          # no answer
+          self._exit(1, status='error')
+          return
+      self._vdeadline('js')
+      LOG.debug(f"phantom.py: Loading finished {self.uri}")
+      self.dtimes['load'] = time.monotonic()
+      self.runJavaScript(sEXTRACT_JS, self._json_callback)
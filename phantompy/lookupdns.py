@@ -6,14 +6,46 @@ Looks for urls https://dns.google/resolve?
 https://dns.google/resolve?name=domain.name&type=TXT&cd=true&do=true
 and parses them to extract a magic field.
 
-A good example of how you can parse json embedded in HTML with phantomjs.
+A good example of how you can parse json embedded in HTML with phantomjs:
+LookFor, in lookfor_phantompy, parses the JSON in the page with sEXTRACT_JS, so only the parsed
+record comes back to Python, and only falls back to toHtml and scanning
+the HTML string with ilookfor if that fails.
 
+Plain JSON answers don't need a browser at all, so ilookfor_fast fetches
+them with a pool of keep-alive HTTP connections (httpx with HTTP/2 if it
+is installed), honoring the same https_proxy environment as Qt, and runs
+the same TXT record check on them. alookfor only falls back to rendering
+with LookFor when the answer is not JSON. The resolver defaults to
+dns.google but can be a local stand-in, e.g. the one in bench_phantompy:
+
+    python3 lookupdns.py --resolver http://127.0.0.1:8080/resolve FP...
+
+dverify checks a batch of fingerprints or names at once, deduped and
+concurrently, and returns {name: (verdict, ttl, timestamp)}, where the
+verdict is True, False or None for no answer. With a LookupCache the
+verdicts are kept on disk for the TTL of the DNS answer they came from,
+so that audits that run often only ask about the names that expired.
 """
 
+import argparse
+import asyncio
+import http.client
+import json
 import sys
 import os
+import threading
+import time
+import urllib.request
+from urllib.parse import parse_qs, urlencode, urlparse
 
-from phantompy import Render
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import h2  # noqa
+except ImportError:
+    h2 = None
 
 global LOG
 import logging
@@ -21,64 +53,339 @@ import warnings
 warnings.filterwarnings('ignore')
 LOG = logging.getLogger()
 
-class LookFor(Render):
-
-  def __init__(self, app, do_print=True, do_save=False):
-    app.lfps = []
-    self._app = app
-    self.do_print = do_print
-    self.do_save = do_save
-    self.progress = 0
-    self.we_run_this_tor_relay = None
-    Render.__init__(self, app, do_print, do_save)
-
-  def _exit(self, val):
-    Render._exit(self, val)
-    self.percent = 100
-    LOG.debug(f"phantom.py: Exiting with val {val}")
-    i = self.uri.find('name=')
-    fp = self.uri[i+5:]
-    i = fp.find('.')
-    fp = fp[:i]
-    # threadsafe?
-    self._app.lfps.append(fp)
-
-  def _html_callback(self, *args):
-    """print(self, QPrinter, Callable[[bool], None])"""
-    if type(args[0]) is str:
-        self._save(args[0])
-        i = self.ilookfor(args[0])
-        self._onConsoleMessage(i, "__PHANTOM_PY_SAVED__", 0 , '')
-
-  def ilookfor(self, html):
-      import json
-      marker = '<pre style="word-wrap: break-word; white-space: pre-wrap;">'
-      if marker not in html: return -1
-      i = html.find(marker) + len(marker)
-      html = html[i:]
-      assert html[0] == '{', html
-      i = html.find('</pre')
-      html = html[:i]
-      assert html[-1] == '}', html
-      LOG.debug(f"Found {len(html)} json")
-      o = json.loads(html)
-      if "Answer" not in o.keys() or type(o["Answer"]) != list:
-          LOG.warn(f"FAIL {self.uri}")
-          return 1
-      for elt in o["Answer"]:
-          assert type(elt) == dict, elt
-          assert 'type' in elt, elt
-          if elt['type'] != 16: continue
-          assert 'data' in elt, elt
-          if elt['data'] == 'we-run-this-tor-relay':
-              LOG.info(f"OK {self.uri}")
-              self.we_run_this_tor_relay = True
-              return 0
-      self.we_run_this_tor_relay = False
-      LOG.warn(f"BAD {self.uri}")
-      return 2
-
-  def _loadFinished(self, result):
-      LOG.debug(f"phantom.py: Loading finished {self.uri}")
-      self.toHtml(self._html_callback)
+sRESOLVER = 'https://dns.google/resolve'
+sMAGIC = 'we-run-this-tor-relay'
+# seconds to remember an answer without a TTL, e.g. NXDOMAIN
+iNEGATIVE_TTL = 300
+
+# the JSON record shown in the page, whatever the markup around it
+sEXTRACT_JS = """
+(function() {
+  var pre = document.querySelector('pre');
+  var txt = pre ? pre.textContent : (document.body ? document.body.innerText : '');
+  try { return JSON.parse(txt); } catch (e) { return null; }
+})()
+"""
+
+def surl_for(sname, sresolver=sRESOLVER):
+    """Return the resolver url of the TXT record of sname."""
+    return sresolver + '?' + urlencode(dict(name=sname, type='TXT', cd='true', do='true'))
+
+def sfp_from_uri(uri):
+    """Return the fingerprint, the first label of the name, in uri."""
+    sname = parse_qs(urlparse(uri).query).get('name', [''])[0]
+    return sname.split('.')[0]
+
+def ittl_json(o):
+    """Return the smallest TTL of the records of the resolver answer o."""
+    lttls = []
+    if type(o) == dict:
+        for skey in ['Answer', 'Authority']:
+            for elt in o.get(skey) or []:
+                # numbers from runJavaScript are floats
+                if type(elt) == dict and type(elt.get('TTL')) in (int, float):
+                    lttls.append(int(elt['TTL']))
+    return min(lttls) if lttls else iNEGATIVE_TTL
+
+def ilookfor_json(o, uri=''):
+    """Check the resolver answer o for the magic TXT record:
+    return 0 if it is there, 2 if not, and 1 if there is no answer,
+    which a malformed answer counts as."""
+    if type(o) != dict or "Answer" not in o.keys() or type(o["Answer"]) != list:
+        LOG.warn(f"FAIL {uri}")
+        return 1
+    for elt in o["Answer"]:
+        if type(elt) != dict or 'type' not in elt or \
+           (elt['type'] == 16 and 'data' not in elt):
+            LOG.warn(f"FAIL malformed record {elt!r} {uri}")
+            return 1
+        if elt['type'] != 16: continue
+        if elt['data'] == sMAGIC:
+            LOG.info(f"OK {uri}")
+            return 0
+    LOG.warn(f"BAD {uri}")
+    return 2
+
+class HttpPool:
+    """Keep-alive HTTP(S) connections per host, for use from threads.
+    Uses httpx, with HTTP/2 if h2 is installed, else http.client.
+    Proxies come from the environment like they do for Qt."""
+
+    def __init__(self, itimeout=30):
+        self.itimeout = itimeout
+        self._lock = threading.Lock()
+        # (scheme, host, port) -> idle http.client connections
+        self._didle = {}
+        self._client = None
+        if httpx is not None:
+            self._client = httpx.Client(http2=h2 is not None, timeout=itimeout,
+                                        trust_env=True)
+
+    def _oconnect(self, o):
+        port = o.port or (443 if o.scheme == 'https' else 80)
+        dproxies = urllib.request.getproxies()
+        sproxy = dproxies.get(o.scheme)
+        if sproxy and urllib.request.proxy_bypass(o.hostname):
+            sproxy = None
+        klass = http.client.HTTPSConnection if o.scheme == 'https' else \
+            http.client.HTTPConnection
+        if not sproxy:
+            return klass(o.hostname, port, timeout=self.itimeout)
+        p = urlparse(sproxy)
+        conn = klass(p.hostname, p.port or 8080, timeout=self.itimeout)
+        conn.set_tunnel(o.hostname, port)
+        return conn
+
+    def tget(self, url, dheaders=None):
+        """GET url and return (status, content_type, body bytes)."""
+        dheaders = dict(dheaders or {})
+        if self._client is not None:
+            resp = self._client.get(url, headers=dheaders)
+            return resp.status_code, resp.headers.get('content-type', ''), resp.content
+        o = urlparse(url)
+        key = (o.scheme, o.hostname, o.port)
+        with self._lock:
+            lidle = self._didle.setdefault(key, [])
+            conn = lidle.pop() if lidle else None
+        spath = o.path or '/'
+        if o.query:
+            spath += '?' + o.query
+        for i in range(2):
+            if conn is None:
+                conn = self._oconnect(o)
+            try:
+                conn.request('GET', spath, headers=dheaders)
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                # the server closed an idle connection: retry on a new one
+                LOG.debug(f"lookupdns: retrying {url} {e}")
+                conn.close()
+                conn = None
+                if i == 1:
+                    raise
+        if resp.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._didle[key].append(conn)
+        return resp.status, resp.getheader('content-type', ''), body
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+        with self._lock:
+            for lidle in self._didle.values():
+                for conn in lidle:
+                    conn.close()
+            self._didle = {}
+
+_oHTTP_POOL = None
+# httpx errors are not OSErrors
+tFETCH_ERRORS = (OSError, http.client.HTTPException) + \
+    ((httpx.HTTPError,) if httpx is not None else ())
+
+def ohttp_pool():
+    """Return the shared HttpPool."""
+    global _oHTTP_POOL
+    if _oHTTP_POOL is None:
+        _oHTTP_POOL = HttpPool()
+    return _oHTTP_POOL
+
+def ofetch_json(url, pool=None):
+    """Return the JSON answer at url, or None if it needs a browser."""
+    pool = pool or ohttp_pool()
+    try:
+        istatus, stype, body = pool.tget(url, {'Accept': 'application/dns-json, application/json'})
+    except tFETCH_ERRORS as e:
+        LOG.debug(f"lookupdns: fetch failed {url} {e}")
+        return None
+    if istatus != 200 or 'json' not in stype:
+        LOG.debug(f"lookupdns: not json {url} {istatus} {stype}")
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+def tlookfor_fast(url, pool=None):
+    """The TXT record check on url without a browser: return the result
+    of ilookfor_json, or -1 if the answer needs a browser, and the TTL."""
+    o = ofetch_json(url, pool)
+    if o is None:
+        return -1, 0
+    return ilookfor_json(o, url), ittl_json(o)
+
+def ilookfor_fast(url, pool=None):
+    """As tlookfor_fast without the TTL."""
+    return tlookfor_fast(url, pool)[0]
+
+async def alookfor(url, app=None, pool=None):
+    """Check url with tlookfor_fast in a thread, and only if that
+    needs a browser, and there is an app, render it with LookFor from
+    the RenderPool pool, or a pool of one page made for it and closed.
+    Return the result of ilookfor_json and the TTL."""
+    loop = asyncio.get_event_loop()
+    i, ittl = await loop.run_in_executor(None, tlookfor_fast, url)
+    if i >= 0 or app is None:
+        return i, ittl
+    LOG.debug(f"lookupdns: rendering {url}")
+    from qasync_phantompy import render
+    if pool is None:
+        pool = olookfor_pool(app)
+        try:
+            result = await render(url, app=app, pool=pool)
+        finally:
+            pool.close()
+    else:
+        result = await render(url, app=app, pool=pool)
+    d = result.data or {}
+    return result.val, d.get('ttl', iNEGATIVE_TTL)
+
+def olookfor_pool(app, isize=1):
+    """Return a RenderPool of LookFor pages: they are made as they are
+    needed, so it costs nothing if every answer is JSON."""
+    from lookfor_phantompy import LookFor
+    from pool_phantompy import RenderPool
+    return RenderPool(app, isize=isize, klass=LookFor)
+
+def verdict(i):
+    """The verdict for the result i of ilookfor_json."""
+    return True if i == 0 else False if i == 2 else None
+
+class LookupCache:
+    """Verdicts on disk in a JSON file of {name: [verdict, ttl, timestamp]},
+    each good for the TTL of the DNS answer it came from."""
+
+    def __init__(self, sfile):
+        self.sfile = sfile
+        self.d = {}
+        if sfile and os.path.exists(sfile):
+            try:
+                with open(sfile, 'rt') as ifd:
+                    self.d = json.load(ifd)
+            except ValueError as e:
+                LOG.warn(f"lookupdns: ignoring bad cache {sfile} {e}")
+
+    def tget(self, sname, now=None):
+        """Return the unexpired (verdict, ttl, timestamp) of sname or None."""
+        elt = self.d.get(sname)
+        if elt is None:
+            return None
+        now = now or time.time()
+        if elt[2] + elt[1] < now:
+            del self.d[sname]
+            return None
+        return tuple(elt)
+
+    def vput(self, sname, t):
+        self.d[sname] = list(t)
+
+    def vsave(self):
+        if not self.sfile:
+            return
+        now = time.time()
+        d = {k: v for k, v in self.d.items() if v[2] + v[1] >= now}
+        stmp = self.sfile + '.tmp'
+        with open(stmp, 'wt') as ofd:
+            json.dump(d, ofd)
+        os.replace(stmp, self.sfile)
+
+async def adverify(lnames, sdomain='', sresolver=sRESOLVER, cache=None,
+                   iconcurrency=16, app=None, pool=None, frate=0.0):
+    """Check the fingerprints or names lnames, as FP.sdomain if sdomain,
+    and return {name: (verdict, ttl, timestamp)}. Names in cache are not
+    asked about again until they expire, and new verdicts are put in it.
+    Answers that need a browser are rendered with LookFor if there is an app.
+    At most frate lookups a second are started, if frate, so as not to be
+    rate limited by the resolver."""
+    from scheduler_phantompy import Scheduler
+    sched = Scheduler(iconcurrency, frate=frate)
+    bpool = app is not None and pool is None
+    if bpool:
+        # one pool for all the answers that need a browser
+        pool = olookfor_pool(app, min(iconcurrency, 4))
+    dresults = {}
+    ltodo = []
+    for sname in dict.fromkeys(elt.strip() for elt in lnames if elt.strip()):
+        t = cache.tget(sname) if cache is not None else None
+        if t is not None:
+            dresults[sname] = t
+        else:
+            ltodo.append(sname)
+    LOG.info(f"lookupdns: {len(dresults)} cached, {len(ltodo)} to look up")
+
+    async def one(sname):
+        sfull = sname + '.' + sdomain if sdomain else sname
+        try:
+            async with sched.oslot(surl_for(sfull, sresolver)):
+                i, ittl = await alookfor(surl_for(sfull, sresolver), app=app, pool=pool)
+        except Exception as e:
+            # one bad answer must not lose the verdicts of the others
+            LOG.warn(f"lookupdns: {sname} {e!r}")
+            i, ittl = 1, iNEGATIVE_TTL
+        t = (verdict(i), ittl, time.time())
+        dresults[sname] = t
+        if cache is not None and t[0] is not None:
+            cache.vput(sname, t)
+
+    try:
+        await asyncio.gather(*[one(sname) for sname in ltodo])
+    finally:
+        if bpool:
+            pool.close()
+    if cache is not None:
+        cache.vsave()
+    return dresults
+
+def dverify(lnames, sdomain='', sresolver=sRESOLVER, cache=None, iconcurrency=16,
+            frate=0.0):
+    """adverify without a browser or a running event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(adverify(lnames, sdomain, sresolver, cache,
+                                                iconcurrency, frate=frate))
+    finally:
+        loop.close()
+
+def __getattr__(sname):
+    # LookFor is a Render, so it is only imported, with Qt, when it is used
+    if sname == 'LookFor':
+        from lookfor_phantompy import LookFor
+        return LookFor
+    raise AttributeError(f"module {__name__} has no attribute {sname}")
+
+def iMain(largs):
+    parser = argparse.ArgumentParser(add_help=True, epilog=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolver', type=str, default=sRESOLVER,
+                        help="The dns-json resolver url")
+    parser.add_argument('--domain', type=str, default='',
+                        help="Domain appended to each fingerprint, as in FP.domain")
+    parser.add_argument('--cache_file', type=str, default='',
+                        help="JSON file to keep the verdicts in for their TTL")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="Lookups at once")
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help="Most lookups started a second (0 for no limit)")
+    parser.add_argument('--log_level', type=int, default=20,
+                        help="10=debug 20=info 30=warn 40=error")
+    parser.add_argument('names', type=str, nargs='*',
+                        help='fingerprints or domain names to check, else from stdin')
+    oargs = parser.parse_args(largs)
+    from support_phantompy import vsetup_logging
+    vsetup_logging(oargs.log_level, logfile='', stream=sys.stderr)
+    lnames = oargs.names or sys.stdin.read().split()
+    cache = LookupCache(oargs.cache_file) if oargs.cache_file else None
+    dresults = dverify(lnames, oargs.domain, oargs.resolver, cache, oargs.concurrency,
+                       oargs.rate)
+    iret = 0
+    for sname, (bverdict, ittl, ftime) in sorted(dresults.items()):
+        print(f"{sname} {bverdict} {ittl}")
+        if bverdict is not True:
+            iret = 1
+    return iret
 
+if __name__ == '__main__':
+    sys.exit(iMain(sys.argv[1:]))
@@ -0,0 +1,134 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+Counters and histograms of render jobs, built from the timings and
+sizes of their RenderResults, exported as Prometheus text or JSON lines.
+
+The stages are the times between the timings of a job:
+  start  waiting in the queue for a page
+  load   loading the page, up to _loadFinished
+  js     running the javascript, up to done
+  html   saving the html, up to _html_callback
+  pdf    printing the pdf, up to _pdf_callback
+  exit   the rest, up to _exit
+and phantompy_job_seconds is the time from being queued to _exit.
+"""
+
+import json
+import os
+import time
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+lBUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+class Histogram:
+
+    def __init__(self, lbuckets=lBUCKETS):
+        self.lbuckets = lbuckets
+        self.lcounts = [0] * len(lbuckets)
+        self.icount = 0
+        self.fsum = 0.0
+
+    def observe(self, fval):
+        self.icount += 1
+        self.fsum += fval
+        for i, fbound in enumerate(self.lbuckets):
+            if fval <= fbound:
+                self.lcounts[i] += 1
+
+class Metrics:
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.dcounters = {}
+        # (name, labels) -> Histogram
+        self.dhistograms = {}
+
+    def _vinc(self, sname, tlabels=(), ival=1):
+        key = (sname, tlabels)
+        self.dcounters[key] = self.dcounters.get(key, 0) + ival
+
+    def _vobserve(self, sname, tlabels, fval):
+        key = (sname, tlabels)
+        if key not in self.dhistograms:
+            self.dhistograms[key] = Histogram()
+        self.dhistograms[key].observe(fval)
+
+    def vobserve(self, dresult):
+        """Count the job dresult, a RenderResult.asdict()."""
+        self._vinc('phantompy_jobs_total', (('status', dresult['status']),))
+        if dresult.get('cached'):
+            self._vinc('phantompy_cached_total')
+        for skind, isize in dresult.get('sizes', {}).items():
+            self._vinc('phantompy_output_bytes_total', (('kind', skind),), isize)
+        if dresult.get('retries'):
+            self._vinc('phantompy_render_retries_total', (), dresult['retries'])
+        for stype, icount in dresult.get('requests', {}).get('blocked', {}).items():
+            self._vinc('phantompy_blocked_requests_total', (('type', stype),), icount)
+        timings = dresult.get('timings', {})
+        prev = 0.0
+        for skey, fval in sorted(timings.items(), key=lambda elt: elt[1]):
+            self._vobserve('phantompy_stage_seconds', (('stage', skey),), fval - prev)
+            prev = fval
+        if 'exit' in timings:
+            self._vobserve('phantompy_job_seconds', (), timings['exit'])
+
+    def sprometheus(self):
+        """Return the metrics in the Prometheus text format."""
+        def slabels(tlabels, extra=()):
+            lelts = [f'{k}="{v}"' for k, v in tuple(tlabels) + tuple(extra)]
+            return '{' + ','.join(lelts) + '}' if lelts else ''
+        lines = []
+        for sname in sorted(set(k[0] for k in self.dcounters)):
+            lines.append(f"# TYPE {sname} counter")
+            for (sn, tlabels), ival in sorted(self.dcounters.items()):
+                if sn == sname:
+                    lines.append(f"{sname}{slabels(tlabels)} {ival}")
+        for sname in sorted(set(k[0] for k in self.dhistograms)):
+            lines.append(f"# TYPE {sname} histogram")
+            for (sn, tlabels), ohist in sorted(self.dhistograms.items(),
+                                               key=lambda elt: elt[0]):
+                if sn != sname: continue
+                for fbound, icount in zip(ohist.lbuckets, ohist.lcounts):
+                    lines.append(f"{sname}_bucket{slabels(tlabels, (('le', fbound),))} {icount}")
+                lines.append(f"{sname}_bucket{slabels(tlabels, (('le', '+Inf'),))} {ohist.icount}")
+                lines.append(f"{sname}_sum{slabels(tlabels)} {ohist.fsum}")
+                lines.append(f"{sname}_count{slabels(tlabels)} {ohist.icount}")
+        return '\n'.join(lines) + '\n'
+
+    def dsnapshot(self):
+        """Return the metrics as a JSON serializable dict."""
+        def skey(sname, tlabels):
+            return sname + ''.join(f",{k}={v}" for k, v in tlabels)
+        return dict(time=time.time(),
+                    counters={skey(*k): v for k, v in self.dcounters.items()},
+                    histograms={skey(*k): dict(count=v.icount, sum=v.fsum,
+                                               buckets=dict(zip(v.lbuckets, v.lcounts)))
+                                for k, v in self.dhistograms.items()})
+
+    def sjson_line(self, dresult=None):
+        """Return one JSON line: the job dresult if given, else the snapshot."""
+        return json.dumps(dresult if dresult is not None else self.dsnapshot())
+
+# the registry that render() counts every job in
+METRICS = Metrics()
+
+def vwrite_metrics(sfile, metrics=METRICS):
+    """If sfile ends in .jsonl append a JSON line snapshot of metrics to it,
+    else replace it with the Prometheus text, atomically so that a scraper
+    never sees half of it."""
+    if sfile.endswith('.jsonl'):
+        with open(sfile, 'at') as ofd:
+            ofd.write(metrics.sjson_line() + '\n')
+        return
+    stmp = sfile + '.tmp'
+    with open(stmp, 'wt') as ofd:
+        ofd.write(metrics.sprometheus())
+    os.replace(stmp, sfile)
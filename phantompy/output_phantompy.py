@@ -0,0 +1,147 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+How Render saves the html output of a job.
+
+The formats are:
+  html      toHtml: the DOM comes to Python as one str, which is written
+            in chunks in a thread, so that the Qt thread is not blocked,
+            compressed with gzip or zstd if asked
+  single    Chromium writes the DOM to the file itself (SingleHtmlSaveFormat)
+  complete  Chromium writes the file and a directory of its subresources
+            (CompleteHtmlSaveFormat)
+  mhtml     Chromium writes one MHTML archive with the subresources
+            (MimeHtmlSaveFormat)
+
+The Chromium formats go through QWebEnginePage.save, so the DOM is never
+copied into Python, and are done when the download of the profile ends.
+"""
+
+import asyncio
+import concurrent.futures
+import gzip
+import importlib
+import os
+
+from qasync import QtModuleName
+
+QtWebEngineWidgets = importlib.import_module(QtModuleName + ".QtWebEngineWidgets", package=QtModuleName)
+QWebEngineDownloadItem = getattr(QtWebEngineWidgets, 'QWebEngineDownloadItem', None)
+if QWebEngineDownloadItem is None:
+    # Qt6 moved it to QtWebEngineCore as QWebEngineDownloadRequest
+    QWebEngineDownloadItem = importlib.import_module(QtModuleName + ".QtWebEngineCore", package=QtModuleName).QWebEngineDownloadRequest
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+lHTML_FORMATS = ['html', 'single', 'complete', 'mhtml']
+lCOMPRESSIONS = ['none', 'gzip', 'zstd']
+dSAVE_FORMATS = {'single': QWebEngineDownloadItem.SingleHtmlSaveFormat,
+                 'complete': QWebEngineDownloadItem.CompleteHtmlSaveFormat,
+                 'mhtml': QWebEngineDownloadItem.MimeHtmlSaveFormat}
+# the characters written at a time, so the encoded copy stays small
+iCHUNK = 1024 * 1024
+
+# the writes of the outputs, off the Qt thread
+_oEXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2,
+                                                   thread_name_prefix='phantompy-write')
+# abspath -> callable(val) of the Chromium saves in flight
+_dPENDING = {}
+# the profiles whose downloadRequested is connected
+_lPROFILES = []
+
+def sfile_for(sfile, scompress='none'):
+    """Return the name sfile is written as with scompress."""
+    if scompress == 'gzip' and not sfile.endswith('.gz'):
+        return sfile + '.gz'
+    if scompress == 'zstd' and not sfile.endswith('.zst'):
+        return sfile + '.zst'
+    return sfile
+
+def vwrite_text(sfile, stext, scompress='none'):
+    """Write the str stext to sfile in chunks, compressed by scompress."""
+    if scompress == 'gzip':
+        with gzip.open(sfile, 'wb', compresslevel=6) as ofd:
+            for i in range(0, len(stext), iCHUNK):
+                ofd.write(stext[i:i + iCHUNK].encode('utf-8'))
+    elif scompress == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd needs the zstandard module: pip install zstandard")
+        with open(sfile, 'wb') as ofd:
+            with zstandard.ZstdCompressor().stream_writer(ofd) as ozfd:
+                for i in range(0, len(stext), iCHUNK):
+                    ozfd.write(stext[i:i + iCHUNK].encode('utf-8'))
+    else:
+        with open(sfile, 'wt', encoding='utf-8') as ofd:
+            for i in range(0, len(stext), iCHUNK):
+                ofd.write(stext[i:i + iCHUNK])
+
+def vwrite_bytes(sfile, bdata):
+    """Write bdata to sfile."""
+    with open(sfile, 'wb') as ofd:
+        ofd.write(bdata)
+
+def vwrite_async(sfile, on_done, fwrite, *args):
+    """Call fwrite(sfile, *args) in a thread and call on_done(val) back on
+    the thread of the running event loop, or write now if there is none."""
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None or not loop.is_running():
+        try:
+            fwrite(sfile, *args)
+        except Exception as e:
+            LOG.error(f"output: writing {sfile} {e}")
+            on_done(1)
+            return
+        on_done(0)
+        return
+
+    def done(fut):
+        e = fut.exception()
+        if e is not None:
+            LOG.error(f"output: writing {sfile} {e}")
+        on_done(1 if e is not None else 0)
+    fut = loop.run_in_executor(_oEXECUTOR, fwrite, sfile, *args)
+    fut.add_done_callback(done)
+
+def vwrite_text_async(sfile, stext, scompress, on_done):
+    """Write stext to sfile in a thread, see vwrite_async."""
+    vwrite_async(sfile, on_done, vwrite_text, stext, scompress)
+
+def _spath(item):
+    if hasattr(item, 'path'):
+        return os.path.abspath(item.path())
+    return os.path.abspath(os.path.join(item.downloadDirectory(), item.downloadFileName()))
+
+def _on_download(item):
+    on_done = _dPENDING.pop(_spath(item), None)
+    if on_done is None:
+        return
+    def finished():
+        bok = item.state() == QWebEngineDownloadItem.DownloadCompleted
+        if not bok:
+            LOG.error(f"output: saving {_spath(item)} {item.interruptReasonString()}")
+        on_done(0 if bok else 1)
+    item.finished.connect(finished)
+
+def vsave_page(page, sfile, sformat, on_done):
+    """Have Chromium save page to sfile in sformat, one of single, complete
+    or mhtml, and call on_done(val) when it is written."""
+    profile = page.profile()
+    if profile not in _lPROFILES:
+        profile.downloadRequested.connect(_on_download)
+        _lPROFILES.append(profile)
+    _dPENDING[os.path.abspath(sfile)] = on_done
+    page.save(sfile, dSAVE_FORMATS[sformat])
@@ -0,0 +1,74 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+The page layout of the PDF output: Render prints with printToPdf into
+bytes in memory, with a QPageLayout that is made once for each set of
+options and reused across jobs.
+
+The options, the keywords of opage_layout, are the paper size by name
+(A4, Letter...), the margins in mm, one number or left, top, right,
+bottom, and the orientation, portrait or landscape. fscale, handled by
+Render, zooms the document before it is printed.
+
+The bytes go to a file, to stdout for -, or to any writable binary
+file object such as a socket's makefile('wb') or an io.BytesIO, and are
+kept on the RenderResult as pdf_bytes.
+"""
+
+import importlib
+import sys
+
+from qasync import QtModuleName
+
+QtCore = importlib.import_module(QtModuleName + ".QtCore", package=QtModuleName)
+QtGui = importlib.import_module(QtModuleName + ".QtGui", package=QtModuleName)
+QMarginsF = QtCore.QMarginsF
+QPageLayout = QtGui.QPageLayout
+QPageSize = QtGui.QPageSize
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+lPAPER_SIZES = ['A3', 'A4', 'A5', 'B4', 'B5', 'Letter', 'Legal', 'Tabloid', 'Executive']
+dORIENTATIONS = {'portrait': QPageLayout.Portrait,
+                 'landscape': QPageLayout.Landscape}
+
+# the layouts made so far, by their options
+_dLAYOUTS = {}
+
+def opage_layout(spaper='A4', fmargins=10, sorientation='portrait'):
+    """Return the QPageLayout for the options, made once and reused."""
+    if spaper not in lPAPER_SIZES:
+        raise ValueError(f"unknown paper size {spaper} not in {lPAPER_SIZES}")
+    if sorientation not in dORIENTATIONS:
+        raise ValueError(f"unknown orientation {sorientation} not in {list(dORIENTATIONS)}")
+    if isinstance(fmargins, (int, float)):
+        tmargins = (float(fmargins),) * 4
+    else:
+        tmargins = tuple(float(elt) for elt in fmargins)
+        if len(tmargins) == 1:
+            tmargins = tmargins * 4
+        if len(tmargins) != 4:
+            raise ValueError(f"margins are one number or left, top, right, bottom: {fmargins}")
+    key = (spaper, tmargins, sorientation)
+    if key not in _dLAYOUTS:
+        _dLAYOUTS[key] = QPageLayout(QPageSize(getattr(QPageSize, spaper)),
+                                     dORIENTATIONS[sorientation],
+                                     QMarginsF(*tmargins),
+                                     QPageLayout.Millimeter)
+    return _dLAYOUTS[key]
+
+def bpdf_path(pdf):
+    """True if pdf is the path of a file, not - or a file object."""
+    return isinstance(pdf, str) and pdf != '-'
+
+def vwrite_stream(pdf, bdata):
+    """Write bdata to stdout for -, or to the binary file object pdf."""
+    ofd = sys.stdout.buffer if pdf == '-' else pdf
+    ofd.write(bdata)
+    ofd.flush()
@@ -118,23 +118,42 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import collections
+import hashlib
 import importlib
+import logging
 import os
+import shutil
 import sys  # noqa
+import time
 
 from qasync import QtModuleName
-from qasync.QtCore import QUrl
 
-QPrinter = importlib.import_module(QtModuleName + ".QtPrintSupport.QPrinter", package=QtModuleName)
-QWebEnginePage = importlib.import_module(QtModuleName + ".QtWebEngineWidgets.QWebEnginePage", package=QtModuleName)
+# qasync has QtCore as an attribute, not a submodule
+QtCore = importlib.import_module(QtModuleName + ".QtCore", package=QtModuleName)
+QTimer = QtCore.QTimer
+QUrl = QtCore.QUrl
+QWebEnginePage = importlib.import_module(QtModuleName + ".QtWebEngineWidgets", package=QtModuleName).QWebEnginePage
+
+from bridge_phantompy import vinstall_bridge, vstamp_job
+from intercept_phantompy import vconfigure_interceptor, vinstall_interceptor
+from output_phantompy import (sfile_for, vsave_page, vwrite_async,
+                              vwrite_bytes, vwrite_text_async)
+from pdf_phantompy import bpdf_path, opage_layout, vwrite_stream
+from profile_phantompy import oprofile
+from ready_phantompy import sready_js
+from scripts_phantompy import sread_script, vinstall_job_script, vremove_job_script
+from support_phantompy import ipid_rss_kb
 
 global LOG
-import logging
 import warnings
 
 warnings.filterwarnings('ignore')
 LOG = logging.getLogger()
 
+# the characters of a console message kept on a RenderResult
+iCONSOLE_CHARS = 1000
+
 def prepare(sdir='/tmp'):
     sfile = os.path.join(sdir, 'test.js')
     if not os.path.exists(sfile):
@@ -159,10 +178,54 @@ def prepare(sdir='/tmp'):
 """)
     LOG.debug(f"wrote {sfile}  ")
 
+class RenderResult:
+  """The outcome of one Render job: status is ok, error, timeout or crashed."""
+
+  def __init__(self, uri, status='ok', val=0, outputs=None, timings=None,
+               data=None, cached=False, sizes=None, requests=None,
+               pdf_bytes=None, retries=0, console=None):
+      self.uri = uri
+      self.status = status
+      self.val = val
+      self.outputs = outputs or {}
+      # seconds from the job being queued to each stage:
+      # start load js html pdf exit
+      self.timings = timings or {}
+      # bytes of each of the outputs
+      self.sizes = sizes or {}
+      # the requests blocked by type, and allowed, by the Interceptor
+      self.requests = requests or {}
+      # what the page passed to phantompy_done, if anything
+      self.data = data
+      # the outputs were copied from a RenderCache
+      self.cached = cached
+      # the printed PDF, not in asdict
+      self.pdf_bytes = pdf_bytes
+      # the loads redone after the renderer process died
+      self.retries = retries
+      # the last console messages of the page: level, line, source, message
+      self.console = console or []
+
+  def asdict(self):
+      return dict(uri=self.uri, status=self.status, val=self.val,
+                  outputs=self.outputs, timings=self.timings, data=self.data,
+                  cached=self.cached, sizes=self.sizes, requests=self.requests,
+                  retries=self.retries, console=self.console)
+
+  def __repr__(self):
+      return f"RenderResult({self.uri!r}, {self.status!r}, {self.val!r})"
+
 class Render(QWebEnginePage):
+  # run the javascript of a job as a script of the page, see run
+  bjob_scripts = True
+
   def __init__(self, app, do_print=False, do_save=True):
-      app.ldone = []
       self._app = app
+      # optional callable(render, val) called from _exit
+      self.on_done = None
+      # optional asyncio future resolved with a RenderResult from _exit
+      self.future = None
+      self.dtimes = {}
       self.do_print = do_print
       self.do_save = do_save
       self.percent = 0
@@ -170,104 +233,450 @@ class Render(QWebEnginePage):
       self.jsfile = None
       self.htmlfile = None
       self.pdffile = None
-      QWebEnginePage.__init__(self)
-
-  def run(self, url, pdffile, htmlfile, jsfile):
-    self._app.lstart.append(id(self))
+      # how to save the html: sformat and scompress, see output_phantompy
+      self.dsave = {}
+      # the opage_layout keywords and fscale of the pdf
+      self.dpdf = {}
+      self.pdf_bytes = None
+      self.data = None
+      # an optional RenderCache and the key of the current job in it
+      self.cache = None
+      self.skey = None
+      self.bcached = False
+      # log every console message of the page, not just the magic ones
+      self.bconsole = False
+      # the last console messages of the job, kept for its result
+      self.lconsole = None
+      self.ijobs = 0
+      # the navigations started by load or setHtml that have not finished
+      self._inavs = 0
+      # the renderer deaths of the page, and the reloads of the current job
+      self.icrashes = 0
+      self.iretries = 0
+      self.imax_retries = 1
+      self._qurl = None
+      self._html_contents = None
+      # seconds allowed for the load, js and output stages of the job
+      self.ddeadlines = {}
+      self.sstage = ''
+      # where and in which world the javascript of the job runs
+      self.sjs_inject = 'load'
+      self.sjs_world = 'main'
+      # all pages share one profile, so one HTTP cache and cookie store
+      QWebEnginePage.__init__(self, oprofile())
+      # connect once here, not in run, so a reused page fires only once
+      self.loadFinished.connect(self._loadFinished)
+      self.renderProcessTerminated.connect(self._onRenderProcessTerminated)
+      self.javaScriptConsoleMessage = self._onConsoleMessage
+      # page scripts can call phantompy_done(data) instead of console.log
+      vinstall_bridge(self)
+      # subresources can be blocked per job
+      vinstall_interceptor(self)
+      self._otimer = QTimer(self)
+      self._otimer.setSingleShot(True)
+      self._otimer.timeout.connect(self._onDeadline)
+
+  def reset(self, do_print=False, do_save=True):
+      """Clear the per job state so that the page can be run again."""
+      self._otimer.stop()
+      self.triggerAction(QWebEnginePage.Stop)
+      if self.skey is not None and not self.bcached:
+          # dont leave the jobs waiting on this one hanging
+          self.cache.vleave(self.skey, self, -1)
+      self.on_done = None
+      self.future = None
+      self.dtimes = {}
+      self.do_print = do_print
+      self.do_save = do_save
+      self.percent = 0
+      self.uri = None
+      self.jsfile = None
+      self.htmlfile = None
+      self.pdffile = None
+      self.dsave = {}
+      self.dpdf = {}
+      self.pdf_bytes = None
+      self.data = None
+      self.cache = None
+      self.skey = None
+      self.bcached = False
+      self.iretries = 0
+      self._qurl = None
+      self._html_contents = None
+      self.ddeadlines = {}
+      self.sstage = ''
+      self.lconsole = None
+
+  def abort(self):
+      """Stop the page loading and running scripts, for a job that is
+      being given up on; the page can then be reset and reused."""
+      self._otimer.stop()
+      self.triggerAction(QWebEnginePage.Stop)
+      # nothing from the blank document can end a job
+      vremove_job_script(self)
+      vstamp_job(self, 0)
+      # a blank document ends the scripts and timers of the page
+      self.setHtml('<html></html>')
+
+  def load(self, qurl):
+      self._inavs += 1
+      QWebEnginePage.load(self, qurl)
+
+  def setHtml(self, html, qbase=QUrl()):
+      self._inavs += 1
+      QWebEnginePage.setHtml(self, html, qbase)
+
+  def _bstale_load(self):
+      """Called on loadFinished: True if it is that of a navigation
+      started before the last load or setHtml, such as the blank page
+      of abort or RenderPool.warm, and not of the current job."""
+      self._inavs = max(0, self._inavs - 1)
+      return self._inavs > 0
+
+  def _vdeadline(self, sstage):
+      """Enter the stage sstage, load js or output, of the job,
+      and start its deadline if it has one."""
+      self.sstage = sstage
+      fsecs = self.ddeadlines.get(sstage, 0)
+      if fsecs:
+          self._otimer.start(int(fsecs * 1000))
+      else:
+          self._otimer.stop()
+
+  def _onDeadline(self):
+      if self.uri is None or self.percent >= 100:
+          return
+      LOG.warn(f"phantom.py: {self.sstage} deadline of {self.ddeadlines.get(self.sstage)}s for {self.uri}")
+      self.abort()
+      self._exit(-1, status='timeout')
+
+  def run(self, url, pdffile, htmlfile, jsfile, dready=None, bconsole=False,
+          js_contents=None, html_contents=None, cache=None, fqueued=None,
+          dintercept=None, dsave=None, dpdf=None, iretries=1,
+          ddeadlines=None, djs=None, iconsole=0):
+    """Start loading url; dready are the sready_js keywords used
+    to decide when the page is done if there is no jsfile,
+    and bconsole logs all of the page's console messages.
+    js_contents is javascript to use instead of jsfile, and html_contents
+    is HTML to render instead of loading url, which is then its base url.
+    If cache is a RenderCache the outputs are copied from it when it has
+    them, and stored in it when rendered.
+    fqueued is the time.monotonic() when the job was queued.
+    dintercept are the keywords of Interceptor.configure for what to block.
+    dsave is how to save the html: sformat html (the default), single,
+    complete or mhtml, and scompress none, gzip or zstd for html.
+    pdffile can also be - for stdout or a writable binary file object,
+    which are not cached, and dpdf are the opage_layout keywords and
+    fscale for the pdf. If the renderer process dies the page is loaded
+    again up to iretries times before the job ends as crashed.
+    ddeadlines are the seconds allowed for the load, js and output
+    stages, 0 or missing for none: when one passes the page is stopped
+    and the job ends as timeout.
+    djs are sinject and sworld for the jsfile or js_contents, see
+    scripts_phantompy: by default deferred in the isolated world. The
+    ready javascript runs in the main world at document creation.
+    The last iconsole console messages of the page are kept, in a ring
+    buffer, for the console of the result."""
+    self.dtimes = dict(start=time.monotonic())
+    if fqueued is not None:
+      self.dtimes['queue'] = fqueued
+    self.bconsole = bconsole
+    self.lconsole = collections.deque(maxlen=iconsole) if iconsole else None
+    self.ijobs += 1
+    self.iretries = 0
+    self.imax_retries = iretries
+    self.ddeadlines = dict(ddeadlines or {})
     self.percent = 10
     self.uri = url
     self.jsfile = jsfile
+    self.dsave = dict(sformat='html', scompress='none')
+    self.dsave.update(dsave or {})
+    if htmlfile and self.dsave['sformat'] == 'html':
+      htmlfile = sfile_for(htmlfile, self.dsave['scompress'])
     self.htmlfile = htmlfile
     self.pdffile = pdffile
+    self.dpdf = dict(dpdf or {})
+    self.pdf_bytes = None
     self.outfile = pdffile or htmlfile
     LOG.debug(f"phantom.py: URL={url} htmlfile={htmlfile} pdffile={pdffile} JSFILE={jsfile}")
     qurl = QUrl.fromUserInput(url)
 
     # The PDF generation only happens when the special string __PHANTOM_PY_DONE__
     # is sent to console.log(). The following JS string will be executed by
-    # default, when no external JavaScript file is specified.
-    self.js_contents = "setTimeout(function() { console.log('__PHANTOM_PY_DONE__') }, 5000);"
-
-    if jsfile:
+    # default, when no external JavaScript file is specified: it sends it as
+    # soon as the page is ready, or after a timeout of 5000 ms at the latest.
+    self.js_contents = sready_js(**(dready or {}))
+    # so that it sees the page's own fetches from the start
+    self.sjs_inject = 'creation'
+    self.sjs_world = 'main'
+
+    if js_contents or jsfile:
+      djs = djs or {}
+      self.sjs_inject = djs.get('sinject', 'deferred')
+      self.sjs_world = djs.get('sworld', 'isolated')
+    if js_contents:
+      self.js_contents = js_contents
+    elif jsfile:
       try:
-        with open(self.jsfile, 'rt') as f:
-            self.js_contents = f.read()
+        self.js_contents = sread_script(self.jsfile)
       except Exception as e: # noqa
         LOG.exception(f"error reading jsfile {self.jsfile}")
 
-    self.loadFinished.connect(self._loadFinished)
+    vconfigure_interceptor(self, qurl.host(), dintercept)
+    self._qurl = qurl
+    self._html_contents = html_contents
+
+    self.cache = cache
+    self.skey = None
+    self.bcached = False
+    if cache is not None and (not pdffile or bpdf_path(pdffile)):
+      doptions = dict(html=bool(htmlfile), pdf=bool(pdffile), dready=dready,
+                      dintercept=dintercept)
+      if dsave:
+        doptions['dsave'] = self.dsave
+      if dpdf:
+        doptions['dpdf'] = self.dpdf
+      if djs:
+        doptions['djs'] = djs
+      if html_contents is not None:
+        doptions['html_contents'] = hashlib.sha256(html_contents.encode('utf-8')).hexdigest()
+      self.skey = cache.skey(url, self.js_contents, doptions)
+      if cache.bjoin(self.skey, self):
+        return
+    self._vload()
+
+  def _vload(self):
+    self._vdeadline('load')
+    vstamp_job(self, self.ijobs)
+    if self.bjob_scripts and self.sjs_inject != 'load':
+      vinstall_job_script(self, self.js_contents, self.sjs_inject, self.sjs_world)
+    else:
+      vremove_job_script(self)
     self.percent = 20
-    self.load(qurl)
-    self.javaScriptConsoleMessage = self._onConsoleMessage
+    if self._html_contents is not None:
+      self.setHtml(self._html_contents, self._qurl)
+    else:
+      self.load(self._qurl)
     LOG.debug(f"phantom.py: loading 10")
 
+  def _onRenderProcessTerminated(self, status, icode):
+      """The renderer died: load the job again, or end it as crashed."""
+      self.icrashes += 1
+      LOG.warn(f"phantom.py: renderer terminated {status} {icode} {self.uri}")
+      if self.uri is None or self.percent >= 100 or self.bcached:
+          return
+      if self.iretries < self.imax_retries:
+          self.iretries += 1
+          for key in ['load', 'js', 'html', 'pdf']:
+              self.dtimes.pop(key, None)
+          # the next load starts a new renderer process
+          self._vload()
+          return
+      self._exit(2, status='crashed')
+
+  def irss_kb(self):
+      """Return the kB of RSS of the renderer process of the page, or 0
+      if this Qt can not tell its pid (before 5.15)."""
+      if not hasattr(self, 'renderProcessPid'):
+          return 0
+      ipid = self.renderProcessPid()
+      return ipid_rss_kb(ipid) if ipid else 0
+
   def _onConsoleMessage(self, *args):
       if len(args) > 3:
           level, txt, lineno, filename = args
       else:
           level = 1
           txt, lineno, filename = args
-      LOG.debug(f"CONSOLE {lineno} {txt} {filename}")
-      if "__PHANTOM_PY_DONE__" in txt:
-          self.percent = 40
-          # If we get this magic string, it means that the external JS is done
-          if self.do_save:
-              self.toHtml(self._html_callback)
-              return
-          # drop through
-          txt = "__PHANTOM_PY_SAVED__"
-      if "__PHANTOM_PY_SAVED__" in txt:
-          self.percent = 50
-          if self.do_print:
-              self._print()
+      if self.lconsole is not None and self.uri is not None:
+          self.lconsole.append(dict(level=int(getattr(level, 'value', level)), line=lineno, source=filename,
+                                    message=txt[:iCONSOLE_CHARS]))
+      elif self.bconsole and LOG.isEnabledFor(logging.DEBUG):
+          LOG.debug(f"CONSOLE {lineno} {txt} {filename}")
+      # the magic string of scripts that predate phantompy_done is
+      # turned into one by the bridge, stamped with the job, so that a
+      # late one from the document of another job is dropped
+
+  def _done(self, val, data=None):
+      """The page or its JS is done: save, then print, then exit."""
+      if self.uri is None or self.percent >= 40:
+          # a left over message from a page that has been reset,
+          # or done seen from both the bridge and the console
+          return
+      self.percent = 40
+      self._vdeadline('output')
+      self.dtimes['js'] = time.monotonic()
+      self.data = data
+      if self.do_save:
+          if self.dsave['sformat'] != 'html':
+              # Chromium writes the file, the DOM never comes to Python
+              vsave_page(self, self.htmlfile, self.dsave['sformat'],
+                         self._on_write(self._saved))
               return
-          txt = "__PHANTOM_PY_PRINTED__"
-      if "__PHANTOM_PY_PRINTED__" in txt:
-          self.percent = 60
-          self._exit(level)
+          self.toHtml(self._html_callback)
+          return
+      self._saved(val)
+
+  def _saved(self, val):
+      if self.uri is None or self.percent >= 100: return
+      self.percent = 50
+      if self.do_save:
+          self.dtimes['html'] = time.monotonic()
+      if self.do_print:
+          self._print()
+          return
+      self._printed(val)
+
+  def _printed(self, val):
+      if self.uri is None or self.percent >= 100: return
+      self.percent = 60
+      if self.do_print:
+          self.dtimes['pdf'] = time.monotonic()
+      self._exit(val)
 
   def _loadFinished(self, result):
-      # RenderProcessTerminationStatus ?
+      if self._bstale_load():
+          LOG.debug(f"phantom.py: dropped a loadFinished from before {self.uri}")
+          return
+      if self.uri is None or self.percent >= 40:
+          # or an injected script was done before the load
+          return
+      self.dtimes['load'] = time.monotonic()
+      if not result:
+          # DNS or connection errors: no script need run on the
+          # error page, so do not wait for the js deadline
+          LOG.warn(f"phantom.py: loading failed {self.uri}")
+          self._exit(1, status='error')
+          return
+      self._vdeadline('js')
       self.percent = 30
       LOG.info(f"phantom.py: _loadFinished {result} {self.percent}")
+      if self.bjob_scripts and self.sjs_inject != 'load':
+          # the job script is already in the page
+          return
       LOG.debug(f"phantom.py: Evaluating JS from {self.jsfile}")
       self.runJavaScript("document.documentElement.contentEditable=true")
       self.runJavaScript(self.js_contents)
 
   def _html_callback(self, *args):
-    """print(self, QPrinter, Callable[[bool], None])"""
+    """toHtml(self, Callable[[str], None])"""
     if type(args[0]) is str:
         self._save(args[0])
-        self._onConsoleMessage(0, "__PHANTOM_PY_SAVED__", 0, '')
 
-  def _save(self, html):
+  def _save(self, html, callback=None):
     sfile = self.htmlfile
-    # CompleteHtmlSaveFormat SingleHtmlSaveFormat MimeHtmlSaveFormat
-    with open(sfile, 'wt') as ofd:
-        ofd.write(html)
-    LOG.debug(f"Saved {sfile}")
-
-  def _printer_callback(self, *args):
-    """print(self, QPrinter, Callable[[bool], None])"""
-    if args[0] is False:
-        i = 1
-    else:
-        i = 0
-    self._onConsoleMessage(i, "__PHANTOM_PY_PRINTED__", 0, '')
+    # written in a thread, and _saved (or callback(val)) when it is done
+    vwrite_text_async(sfile, html, self.dsave['scompress'],
+                      self._on_write(callback or self._saved))
+    LOG.debug(f"Saving {sfile}")
+
+  def _on_write(self, callback):
+    """Wrap callback(val) so that it is dropped if the page has been
+    reset or rerun since the write started."""
+    ijob = self.ijobs
+    def on_done(val):
+        if self.uri is None or self.ijobs != ijob or self.percent >= 100:
+            return
+        callback(val)
+    return on_done
+
+  def _pdf_callback(self, *args):
+    """printToPdf(self, Callable[[QByteArray], None], QPageLayout)"""
+    bdata = bytes(args[0]) if args and args[0] is not None else b''
+    if not bdata:
+        LOG.error(f"phantom.py: printing {self.uri} gave no pdf")
+        self._printed(1)
+        return
+    self.pdf_bytes = bdata
+    if bpdf_path(self.pdffile):
+        vwrite_async(self.pdffile, self._on_write(self._printed),
+                     vwrite_bytes, bdata)
+        return
+    try:
+        vwrite_stream(self.pdffile, bdata)
+    except (OSError, ValueError) as e:
+        LOG.error(f"phantom.py: writing the pdf of {self.uri} {e}")
+        self._printed(1)
+        return
+    self._printed(0)
 
   def _print(self):
-    sfile = self.pdffile
-    printer = QPrinter()
-    printer.setPageMargins(10, 10, 10, 10, QPrinter.Millimeter)
-    printer.setPaperSize(QPrinter.A4)
-    printer.setCreator("phantom.py by Michael Karl Franzl")
-    printer.setOutputFormat(QPrinter.PdfFormat)
-    printer.setOutputFileName(sfile)
-    self.print(printer, self._printer_callback)
-    LOG.debug("phantom.py: Printed")
-
-  def _exit(self, val):
+    dlayout = dict(self.dpdf)
+    fscale = dlayout.pop('fscale', 1.0)
+    try:
+        layout = opage_layout(**dlayout)
+    except ValueError as e:
+        # raised in a Qt callback it would leave the job hanging
+        LOG.error(f"phantom.py: printing {self.uri} {e}")
+        self._printed(1)
+        return
+    if fscale == 1.0:
+        self.printToPdf(self._pdf_callback, layout)
+    else:
+        self.runJavaScript(f"document.documentElement.style.zoom = {float(fscale)}",
+                           lambda *args: self.printToPdf(self._pdf_callback, layout))
+    LOG.debug("phantom.py: Printing")
+
+  def oresult(self, val, status=None):
+      """Return a RenderResult for the current job."""
+      if status is None:
+          status = 'ok' if val == 0 else 'error'
+      outputs = {}
+      if self.do_save and self.htmlfile:
+          outputs['html'] = self.htmlfile
+      if self.do_print and bpdf_path(self.pdffile):
+          outputs['pdf'] = self.pdffile
+      timings = {}
+      start = self.dtimes.get('queue', self.dtimes.get('start'))
+      if start is not None:
+          for key, elt in self.dtimes.items():
+              if key == 'queue': continue
+              timings[key] = elt - start
+      sizes = {}
+      for key, sfile in outputs.items():
+          if os.path.exists(sfile):
+              sizes[key] = os.path.getsize(sfile)
+      if self.pdf_bytes is not None:
+          sizes['pdf'] = len(self.pdf_bytes)
+      requests = {} if self.bcached else self._interceptor.dcounts()
+      return RenderResult(self.uri, status, val, outputs, timings, self.data,
+                          self.bcached, sizes, requests, self.pdf_bytes,
+                          self.iretries, list(self.lconsole or []))
+
+  def _cached(self, skey, meta):
+      """Finish the job with the outputs of the cache entry meta."""
+      for skind, sfile in [('html', self.htmlfile), ('pdf', self.pdffile)]:
+          if not sfile or skind not in meta['files']: continue
+          scached = self.cache.sfile(skey, meta, skind)
+          if os.path.abspath(sfile) != os.path.abspath(scached):
+              try:
+                  shutil.copyfile(scached, sfile)
+              except OSError as e:
+                  LOG.error(f"phantom.py: copying {scached} to {sfile} {e}")
+                  self._exit(1, status='error')
+                  return
+      self.data = meta.get('data')
+      self.bcached = True
+      LOG.debug(f"phantom.py: from cache {self.uri}")
+      self._exit(0)
+
+  def _exit(self, val, status=None):
+      if self.uri is None or self.percent >= 100:
+          # a callback of a job that has already ended
+          return
+      self._otimer.stop()
       self.percent = 100
+      self.dtimes['exit'] = time.monotonic()
       LOG.debug(f"phantom.py: Exiting with val {val}")
-      # threadsafe?
-      self._app.ldone.append(self.uri)
+      if self.skey is not None and not self.bcached:
+          skey = self.skey
+          self.skey = None
+          try:
+              self.cache.vleave(skey, self, val)
+          except Exception as e:
+              # the job is answered even if the cache is broken
+              LOG.exception(f"phantom.py: cache {self.uri} {e}")
+      if self.future is not None and not self.future.done():
+          self.future.set_result(self.oresult(val, status))
+      if self.on_done is not None:
+          self.on_done(self, val)
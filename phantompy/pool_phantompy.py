@@ -0,0 +1,125 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+A pool of Render pages that are created once and reused across jobs.
+
+Creating a QWebEnginePage and starting its renderer process is the
+largest per url cost, so the pool hands out idle pages, resets their
+per job state when they are released, and only creates new pages up to
+its size.
+
+Pages that have done imax_jobs jobs, whose renderer process has grown
+over imax_rss_mb, or whose renderer has died, are deleted when they are
+released and replaced by a fresh page, so long batches do not grow
+without bound; dstats counts them by reason.
+
+    pool = RenderPool(app, isize=4)
+    r = await pool.acquire(do_print=False, do_save=True)
+    try:
+        r.run(url, pdffile, htmlfile, jsfile)
+        ...
+    finally:
+        pool.release(r)
+"""
+
+import asyncio
+
+from phantompy import Render
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+class RenderPool:
+
+    def __init__(self, app, isize=4, klass=Render, imax_jobs=0, imax_rss_mb=0):
+        self._app = app
+        self._klass = klass
+        self.isize = max(1, isize)
+        # 0 for no limit
+        self.imax_jobs = imax_jobs
+        self.imax_rss_mb = imax_rss_mb
+        # reason -> pages recycled for it
+        self.drecycled = dict(jobs=0, rss=0, crashed=0)
+        self.icrashes = 0
+        self._lall = []
+        self._idle = None
+        self.icreated = 0
+        self.ireused = 0
+
+    def _oidle(self):
+        # created lazily so that the queue binds to the running loop
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        return self._idle
+
+    def _onew(self):
+        r = self._klass(self._app)
+        self._lall.append(r)
+        self.icreated += 1
+        LOG.debug(f"pool: created page {len(self._lall)} of {self.isize}")
+        return r
+
+    def warm(self, inum=None):
+        """Create up to inum idle pages now, starting their renderers."""
+        inum = self.isize if inum is None else min(inum, self.isize)
+        while len(self._lall) < inum:
+            r = self._onew()
+            r.setHtml('<html></html>')
+            self._oidle().put_nowait(r)
+
+    async def acquire(self, do_print=False, do_save=True):
+        """Return a reset page, waiting for one if the pool is exhausted."""
+        idle = self._oidle()
+        if idle.empty() and len(self._lall) < self.isize:
+            r = self._onew()
+        else:
+            r = await idle.get()
+            self.ireused += 1
+        r.reset(do_print=do_print, do_save=do_save)
+        return r
+
+    def _sworn(self, r):
+        """Return why r should be recycled, or ''."""
+        if r.icrashes:
+            return 'crashed'
+        if self.imax_jobs and r.ijobs >= self.imax_jobs:
+            return 'jobs'
+        if self.imax_rss_mb and r.irss_kb() > self.imax_rss_mb * 1024:
+            return 'rss'
+        return ''
+
+    def release(self, r):
+        """Return the page r to the pool for the next job,
+        or a fresh page in its place if r is worn out."""
+        r.reset()
+        sreason = self._sworn(r)
+        if sreason:
+            LOG.info(f"pool: recycling a page for {sreason} after {r.ijobs} jobs")
+            self.drecycled[sreason] += 1
+            self.icrashes += r.icrashes
+            self._lall.remove(r)
+            r.deleteLater()
+            r = self._onew()
+            r.setHtml('<html></html>')
+        self._oidle().put_nowait(r)
+
+    def close(self):
+        for r in self._lall:
+            r.deleteLater()
+        self._lall = []
+        self._idle = None
+
+    def dstats(self):
+        return dict(size=self.isize,
+                    pages=len(self._lall),
+                    idle=self._oidle().qsize(),
+                    created=self.icreated,
+                    reused=self.ireused,
+                    recycled=dict(self.drecycled),
+                    crashes=self.icrashes + sum(r.icrashes for r in self._lall),
+                    rss_kb=sum(r.irss_kb() for r in self._lall))
@@ -0,0 +1,109 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+The QWebEngineProfile shared by all Render pages, so that they share one
+HTTP cache, connection pool and cookie store.
+
+By default this is Qt's default profile. vconfigure_profile, called
+before the first page is made, sets up a named profile instead, with
+its HTTP cache and storage kept in sdir across runs:
+
+    vconfigure_profile(sdir='~/.cache/phantompy', icache_mb=512)
+
+shttp_cache is disk, memory or none, and scookies is none (session
+cookies only), allow (persist the cookies that ask to be) or force.
+dprofile_info describes the profile and how much its cache holds.
+"""
+
+import importlib
+import os
+
+from qasync import QtModuleName
+
+try:
+    QWebEngineProfile = importlib.import_module(QtModuleName + ".QtWebEngineCore", package=QtModuleName).QWebEngineProfile
+except (ImportError, AttributeError):
+    QWebEngineProfile = importlib.import_module(QtModuleName + ".QtWebEngineWidgets", package=QtModuleName).QWebEngineProfile
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+dHTTP_CACHE_TYPES = {'disk': QWebEngineProfile.DiskHttpCache,
+                     'memory': QWebEngineProfile.MemoryHttpCache,
+                     'none': QWebEngineProfile.NoCache}
+dCOOKIE_POLICIES = {'none': QWebEngineProfile.NoPersistentCookies,
+                    'allow': QWebEngineProfile.AllowPersistentCookies,
+                    'force': QWebEngineProfile.ForcePersistentCookies}
+
+_dCONFIG = None
+_oPROFILE = None
+
+def vconfigure_profile(sdir='', sname='phantompy', icache_mb=0,
+                       shttp_cache='disk', scookies='allow'):
+    """Set up the shared profile: call before the first Render is made.
+    icache_mb 0 lets Qt choose the size of the HTTP cache."""
+    global _dCONFIG
+    if _oPROFILE is not None:
+        LOG.warn("profile: already in use, not reconfiguring")
+        return
+    if shttp_cache not in dHTTP_CACHE_TYPES:
+        raise ValueError(f"unknown http cache {shttp_cache} not in {list(dHTTP_CACHE_TYPES)}")
+    if scookies not in dCOOKIE_POLICIES:
+        raise ValueError(f"unknown cookies policy {scookies} not in {list(dCOOKIE_POLICIES)}")
+    _dCONFIG = dict(sdir=os.path.expanduser(sdir), sname=sname, icache_mb=icache_mb,
+                    shttp_cache=shttp_cache, scookies=scookies)
+
+def oprofile():
+    """Return the profile shared by all Render pages."""
+    global _oPROFILE
+    if _oPROFILE is not None:
+        return _oPROFILE
+    if _dCONFIG is None:
+        _oPROFILE = QWebEngineProfile.defaultProfile()
+        return _oPROFILE
+    d = _dCONFIG
+    # a named profile is on disk, not off the record
+    profile = QWebEngineProfile(d['sname'])
+    if d['sdir']:
+        os.makedirs(d['sdir'], exist_ok=True)
+        profile.setCachePath(os.path.join(d['sdir'], 'cache'))
+        profile.setPersistentStoragePath(os.path.join(d['sdir'], 'storage'))
+    profile.setHttpCacheType(dHTTP_CACHE_TYPES[d['shttp_cache']])
+    if d['icache_mb']:
+        profile.setHttpCacheMaximumSize(d['icache_mb'] * 1024 * 1024)
+    profile.setPersistentCookiesPolicy(dCOOKIE_POLICIES[d['scookies']])
+    LOG.info(f"profile: {d['sname']} cache {profile.cachePath()}")
+    _oPROFILE = profile
+    return _oPROFILE
+
+def idir_size(sdir):
+    """Return the bytes of the files under sdir."""
+    isize = 0
+    for sroot, ldirs, lfiles in os.walk(sdir):
+        for elt in lfiles:
+            try:
+                isize += os.path.getsize(os.path.join(sroot, elt))
+            except OSError:
+                pass
+    return isize
+
+def dprofile_info(profile=None):
+    """Describe the profile and the bytes its HTTP cache holds on disk."""
+    profile = profile or oprofile()
+    dtypes = {v: k for k, v in dHTTP_CACHE_TYPES.items()}
+    dcookies = {v: k for k, v in dCOOKIE_POLICIES.items()}
+    scache = profile.cachePath()
+    return dict(name=profile.storageName(),
+                off_the_record=profile.isOffTheRecord(),
+                cache_path=scache,
+                cache_bytes=idir_size(scache) if scache and os.path.isdir(scache) else 0,
+                cache_max_bytes=profile.httpCacheMaximumSize(),
+                http_cache=dtypes.get(profile.httpCacheType(), str(profile.httpCacheType())),
+                storage_path=profile.persistentStoragePath(),
+                cookies=dcookies.get(profile.persistentCookiesPolicy(),
+                                     str(profile.persistentCookiesPolicy())))
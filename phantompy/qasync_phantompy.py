@@ -2,15 +2,17 @@
 # -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
 
 import asyncio
+import json
 import os
+import pathlib
 import sys
+import time
+from urllib.parse import urlsplit, urlunsplit
 
-# let qasync figure out what Qt we are using - we dont care
-from qasync import QApplication, QEventLoop, QtWidgets
-
-from phantompy import Render
-# if you want an example of looking for things in downloaded HTML:
-# from lookupdns import LookFor as Render
+# Qt is imported when a render starts, not here, so that --help,
+# the completion and the shard supervisor do not pay for it
+from metrics_phantompy import METRICS, vwrite_metrics
+from scheduler_phantompy import Scheduler
 from support_phantompy import omain_argparser, vsetup_logging
 
 global LOG
@@ -25,76 +27,381 @@ try:
 except:
     shtab = None
 
-class Widget(QtWidgets.QWidget):
-    def __init__(self):
-        QtWidgets.QWidget.__init__(self)
-        self._label = QtWidgets.QLabel()
-        box = QtWidgets.QHBoxLayout()
-        self.setLayout(box)
-        box.addWidget(self._label)
-        self.progress = QtWidgets.QProgressBar()
-        self.progress.setRange(0, 99)
-        box.addWidget(self.progress)
+def oqapp(largs=None):
+    """Return the QApplication, made once: QtWebEngine is imported first,
+    as it has to be before the application is made."""
+    # let qasync figure out what Qt we are using - we dont care
+    from qasync import QApplication
+
+    import phantompy  # noqa
+    app = QApplication.instance()
+    if app is None:
+        app = QApplication(largs or [])
+    return app
 
-    def update(self, text):
-        i = len(asyncio.all_tasks())
-        self._label.setText(str(i))
-        self.progress.setValue(int(text))
+def owidget(app):
+    """Return a new progress Widget for the --show_gui window."""
+    from qasync import QtWidgets
 
-class ContextManager:
+    class Widget(QtWidgets.QWidget):
+        def __init__(self):
+            QtWidgets.QWidget.__init__(self)
+            self._label = QtWidgets.QLabel()
+            box = QtWidgets.QHBoxLayout()
+            self.setLayout(box)
+            box.addWidget(self._label)
+            self.progress = QtWidgets.QProgressBar()
+            self.progress.setRange(0, 99)
+            box.addWidget(self.progress)
 
-    def __init__(self) -> None:
-        self._seconds = 0
+        def update(self, text):
+            i = len(asyncio.all_tasks())
+            self._label.setText(str(i))
+            self.progress.setValue(int(text))
 
-    async def __aenter__(self):
-        LOG.debug("ContextManager enter")
-        return self
+    widget = Widget()
+    widget._app = app
+    return widget
 
-    async def __aexit__(self, *args):
-        LOG.debug("ContextManager exit")
+def sfromuserinput(surl):
+    """Return the url meant by surl, as QUrl.fromUserInput does for the
+    usual cases but without Qt: the path of a file is a file url, and no
+    scheme is http. The scheme and host are lowercased."""
+    surl = surl.strip()
+    if os.path.exists(surl):
+        return pathlib.Path(os.path.abspath(surl)).as_uri()
+    if '://' not in surl and \
+       not surl.lower().startswith(('about:', 'data:', 'file:', 'javascript:')):
+        surl = 'http://' + surl
+    o = urlsplit(surl)
+    suser, sat, shost = o.netloc.rpartition('@')
+    return urlunsplit((o.scheme.lower(), suser + sat + shost.lower(),
+                       o.path, o.query, o.fragment))
 
-    async def tick(self):
-        await asyncio.sleep(1)
-        self._seconds += 1
-        return self._seconds
+async def render(url, js='', html='', pdf='', app=None, pool=None, itimeout=120,
+                 fqueued=None, **kw):
+    """Render url, running the javascript file js and writing the html
+    and pdf outputs if given, and return a RenderResult.
+    The keywords kw are passed on to Render.run, e.g. dready or ddeadlines,
+    and itimeout is the seconds allowed for the whole job.
+    fqueued is the time.monotonic() the job was queued at, e.g. the
+    fqueued of its Scheduler ticket, else now.
+    If the job times out or is cancelled the page is stopped.
+    The page is taken from pool if given, else a new Render is made.
+    Many jobs can be run at once with asyncio.gather.
+    """
+    # if you want an example of looking for things in downloaded HTML:
+    # from lookupdns import LookFor as Render
+    from phantompy import Render
+    if app is None:
+        app = oqapp()
+    if fqueued is None:
+        fqueued = time.monotonic()
+    loop = asyncio.get_event_loop()
+    do_print = True if pdf else False
+    do_save = True if html else False
+    if pool is not None:
+        r = await pool.acquire(do_print=do_print, do_save=do_save)
+    else:
+        r = Render(app, do_print=do_print, do_save=do_save)
+    r.future = loop.create_future()
+    try:
+        r.run(url.strip(), pdf, html, js, fqueued=fqueued, **kw)
+        result = await asyncio.wait_for(r.future, itimeout)
+    except asyncio.TimeoutError:
+        LOG.warn(f"timeout {url}")
+        r.abort()
+        result = r.oresult(-1, status='timeout')
+    except asyncio.CancelledError:
+        # stop the page before it goes back to the pool
+        r.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.release(r)
+        else:
+            r.deleteLater()
+    METRICS.vobserve(result.asdict())
+    return result
 
-async def main(widget, app, ilen):
+async def main(widget, app, url, htmlfile='', pdffile='', jsfile='', dkw=None,
+               bextract=False):
     LOG.debug("Task started")
     try:
-        async with ContextManager() as ctx:
-            for i in range(1, 120):
-                seconds = await ctx.tick()
-                if widget:
-                    widget.update(str(i))
-                if len(app.ldone) == ilen:
-                    LOG.info(f"Finished with {app.ldone}")
-                    print('\n'.join(app.ldone))
-                    app.exit()
-                    # raise  asyncio.CancelledError
-                    return
-                LOG.debug(f"{app.ldone} {seconds}")
+        if widget:
+            widget.update('10')
+        result = await render(url, js=jsfile, html=htmlfile, pdf=pdffile, app=app,
+                              **(dkw or {}))
+        LOG.info(f"Finished with {result}")
+        if bextract:
+            from extract_phantompy import sndjson
+            print(sndjson(result.asdict()), flush=True)
+        elif pdffile != '-':
+            # else stdout is the pdf
+            print(result.uri)
     except asyncio.CancelledError as ex: # noqa
         LOG.debug("Task cancelled")
+    except Exception as e:
+        LOG.exception(f"{url} {e}")
+        if bextract:
+            from extract_phantompy import sndjson
+            print(sndjson(dict(uri=url, status='error', data=None)), flush=True)
+    finally:
+        app.exit()
+
+def lread_batch(sfile, htmlfile='', pdffile=''):
+    """Read lines of: url [html_output [pdf_output]] from sfile or - for stdin.
+    Urls are normalized with sfromuserinput and duplicates dropped.
+    htmlfile and pdffile are directories for lines without their own outputs.
+    """
+    if sfile == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(sfile, 'rt') as ifd:
+            lines = ifd.readlines()
+    seen = set()
+    ljobs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+        lelts = line.split()
+        uri = sfromuserinput(lelts[0])
+        if uri in seen:
+            LOG.debug(f"duplicate {uri}")
+            continue
+        seen.add(uri)
+        # the default outputs, if given, are directories to write into
+        shtml = lelts[1] if len(lelts) > 1 else \
+          os.path.join(htmlfile, f"{len(ljobs)}.html") if htmlfile else ''
+        spdf = lelts[2] if len(lelts) > 2 else \
+          os.path.join(pdffile, f"{len(ljobs)}.pdf") if pdffile else ''
+        # - stands for no output, so a line can have a pdf and no html
+        if shtml == '-': shtml = ''
+        if spdf == '-': spdf = ''
+        ljobs.append((uri, shtml, spdf))
+    return ljobs
+
+def ljournal_pending(journal, ljobs, bextract=False):
+    """Return the jobs of ljobs that journal has not done; with bextract
+    print the NDJSON lines of the done ones again, from the journal, so
+    the output is that of the whole batch."""
+    if bextract:
+        from extract_phantompy import sndjson
+        for elt in ljobs:
+            if journal.bdone(elt[0]):
+                print(sndjson(journal.dfinished(elt[0])), flush=True)
+    return journal.lpending(ljobs)
+
+async def batch(widget, app, ljobs, jsfile='', iconcurrency=4, dkw=None,
+                dpool=None, dsched=None, journal=None, bextract=False):
+    """Render ljobs keeping at most iconcurrency pages in flight,
+    printing each url as soon as it is done, or with bextract the NDJSON
+    line of each, ok or not.
+    dpool are the RenderPool keywords imax_jobs and imax_rss_mb, and
+    dsched the Scheduler keywords ihost_concurrency, frate and iburst.
+    journal, a journal_phantompy.Journal, gets the start and finish of
+    each job."""
+    from extract_phantompy import sndjson
+    from journal_phantompy import dhash_outputs
+    from pool_phantompy import RenderPool
+    LOG.debug(f"Batch started {len(ljobs)}")
+    pool = RenderPool(app, isize=iconcurrency, **(dpool or {}))
+    pool.warm()
+    sched = Scheduler(iconcurrency, **(dsched or {}))
+    ldone = []
+
+    async def job(uri, htmlfile, pdffile):
+        try:
+            async with sched.oslot(uri) as ticket:
+                if journal:
+                    journal.vstart(uri)
+                result = await render(uri, js=jsfile, html=htmlfile, pdf=pdffile,
+                                      app=app, pool=pool, fqueued=ticket.fqueued,
+                                      **(dkw or {}))
+            dresult = result.asdict()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # one broken job must not take the rest of the batch with it
+            LOG.exception(f"{uri} {e}")
+            dresult = dict(uri=uri, status='error', val=1, outputs={}, data=None)
+        if journal:
+            dhashes = {}
+            if dresult['status'] == 'ok':
+                dhashes = await asyncio.get_event_loop().run_in_executor(
+                    None, dhash_outputs, dresult['outputs'])
+            journal.vfinish(dresult, dhashes)
+        if bextract:
+            print(sndjson(dresult), flush=True)
+        if dresult['status'] != 'ok':
+            LOG.warn(f"{dresult['status']} {uri}")
+            return
+        ldone.append(uri)
+        if not bextract:
+            print(uri, flush=True)
+        if widget:
+            widget.update(str(int(100 * len(ldone) / len(ljobs))))
+        LOG.debug(f"done {result}")
+
+    try:
+        await asyncio.gather(*[job(*elt) for elt in ljobs])
+        LOG.info(f"Finished {len(ldone)} of {len(ljobs)} {pool.dstats()}")
+        LOG.info(f"Scheduled {sched.dstats()}")
+    except asyncio.CancelledError as ex: # noqa
+        LOG.debug("Batch cancelled")
+    finally:
+        pool.close()
+        app.exit()
+
+async def awarm(app, lurls, iconcurrency=4):
+    """Load lurls without outputs, to fill the profile's HTTP cache."""
+    from pool_phantompy import RenderPool
+    pool = RenderPool(app, isize=iconcurrency)
+    lresults = await asyncio.gather(*[render(url, app=app, pool=pool,
+                                             dready=dict(smode='load'))
+                                      for url in lurls])
+    pool.close()
+    LOG.info(f"warmed the cache with {len([r for r in lresults if r.status == 'ok'])} of {len(lurls)}")
 
 def iMain(largs):
     parser = omain_argparser()
     if shtab:
         shtab.add_argument_to(parser, ["-s", "--print-completion"]) # magic!
     oargs = parser.parse_args(largs)
+    if not oargs.html_url and not oargs.batch_input and not oargs.server \
+       and not oargs.cache_info and not oargs.warm_cache:
+        parser.error("html_url or --batch_input or --server is required")
+    if oargs.ready == 'selector' and not oargs.ready_selector:
+        parser.error("--ready selector needs --ready_selector")
+    try:
+        lmargins = [float(elt) for elt in oargs.pdf_margins.split(',')]
+    except ValueError:
+        lmargins = []
+    if len(lmargins) not in [1, 4]:
+        parser.error("--pdf_margins is one number or left,top,right,bottom")
+    if oargs.pdf_output == '-' and (oargs.batch_input or oargs.server):
+        parser.error("--pdf_output - is for one url")
+    if oargs.extract and (oargs.js_input or oargs.server):
+        parser.error("--extract is instead of --js_input, and not for --server")
+    if oargs.server and ':' in oargs.server and not oargs.server.startswith('/') \
+       and not oargs.server_dir:
+        # any local user can connect to a port, see server_phantompy
+        parser.error("--server on a TCP port needs --server_dir")
+    if oargs.warm_cache and oargs.batch_input and oargs.processes > 1:
+        # each worker has a profile, and an HTTP cache, of its own
+        parser.error("--warm_cache is not for --processes more than 1")
+    if oargs.cache_dir and oargs.batch_input and oargs.processes > 1:
+        # the cache index and its in-flight jobs are kept in one process
+        parser.error("--cache_dir is not for --processes more than 1")
     bgui = oargs.show_gui
 
     try:
         d = int(os.environ.get('DEBUG', 0))
         if d > 0:
             oargs.log_level = 10
-        vsetup_logging(oargs.log_level, logfile='', stream=sys.stderr)
+        vsetup_logging(oargs.log_level, logfile='', stream=sys.stderr,
+                       bqueue=oargs.log_queue)
     except: pass
 
-    app = QApplication([])
-    app.lstart = []
+    url = oargs.html_url
+    htmlfile = oargs.html_output
+    pdffile = oargs.pdf_output
+    jsfile = oargs.js_input
+    # the keywords for Render.run
+    dkw = dict(dready=dict(smode=oargs.ready,
+                           itimeout=oargs.ready_timeout,
+                           iidle=oargs.ready_idle,
+                           sselector=oargs.ready_selector),
+               bconsole=oargs.console,
+               iconsole=oargs.console_lines,
+               djs=dict(sinject=oargs.js_inject, sworld=oargs.js_world),
+               iretries=oargs.retries,
+               ddeadlines=dict(load=oargs.load_timeout, js=oargs.js_timeout,
+                               output=oargs.output_timeout),
+               dsave=dict(sformat=oargs.html_format, scompress=oargs.html_compress),
+               dpdf=dict(spaper=oargs.pdf_paper,
+                         fmargins=lmargins,
+                         sorientation=oargs.pdf_orientation,
+                         fscale=oargs.pdf_scale),
+               dintercept=dict(sprofile=oargs.block_profile,
+                               lpatterns=oargs.block,
+                               lallow_hosts=[elt for elt in oargs.allow_hosts.split(',') if elt]))
+    bextract = bool(oargs.extract)
+    if bextract:
+        from extract_phantompy import sextract_js
+        # the extractor runs when the page is ready, as the ready
+        # javascript does, and there are no html or pdf outputs
+        try:
+            dkw['js_contents'] = sextract_js(oargs.extract, dkw['dready'])
+        except (OSError, ValueError) as e:
+            parser.error(f"--extract {e}")
+        dkw['djs'] = dict(sinject='creation', sworld='main')
+        htmlfile = pdffile = ''
+    if oargs.cache_dir:
+        from cache_phantompy import RenderCache
+        dkw['cache'] = RenderCache(oargs.cache_dir, ittl=oargs.cache_ttl,
+                                   isize=oargs.cache_size * 1024 * 1024)
+
+    # the keywords for RenderPool
+    dpool = dict(imax_jobs=oargs.recycle_jobs, imax_rss_mb=oargs.recycle_rss_mb)
+
+    # the keywords for Scheduler
+    dsched = dict(ihost_concurrency=oargs.host_concurrency,
+                  frate=oargs.host_rate, iburst=oargs.host_burst)
+
+    # the keywords for profile_phantompy.vconfigure_profile
+    dprofile = None
+    if oargs.profile_dir or oargs.http_cache != 'disk' or oargs.http_cache_mb \
+       or oargs.cookies != 'allow':
+        dprofile = dict(sdir=oargs.profile_dir, icache_mb=oargs.http_cache_mb,
+                        shttp_cache=oargs.http_cache, scookies=oargs.cookies)
+
+    journal = None
+    if oargs.journal and oargs.batch_input:
+        from journal_phantompy import Journal
+        journal = Journal(oargs.journal)
+
+    if oargs.batch_input and oargs.processes > 1:
+        from extract_phantompy import sndjson
+        from journal_phantompy import dhash_outputs
+        from shard_phantompy import lrun_shards
+        ljobs = lread_batch(oargs.batch_input, htmlfile, pdffile)
+        if bextract:
+            ljobs = [(elt[0], '', '') for elt in ljobs]
+        if journal:
+            ljobs = ljournal_pending(journal, ljobs, bextract)
+        LOG.info(f"queued {len(ljobs)} urls")
+        def on_start(d):
+            if journal:
+                journal.vstart(d['uri'])
+        def on_result(d):
+            METRICS.vobserve(d)
+            if journal:
+                journal.vfinish(d, dhash_outputs(d['outputs']) if d['status'] == 'ok' else {})
+            if bextract:
+                print(sndjson(d), flush=True)
+            if d['status'] == 'ok' and not bextract:
+                print(d['uri'], flush=True)
+            elif d['status'] != 'ok':
+                LOG.warn(f"{d['status']} {d['uri']}")
+        lresults = lrun_shards(ljobs, oargs.processes, jsfile, oargs.concurrency,
+                               dkw, oargs.log_level, on_result=on_result,
+                               dprofile=dprofile, dpool=dpool, dsched=dsched,
+                               on_start=on_start)
+        LOG.info(f"Finished {len([d for d in lresults if d['status'] == 'ok'])} of {len(ljobs)}")
+        if journal:
+            journal.close()
+        if oargs.metrics_output:
+            vwrite_metrics(oargs.metrics_output)
+        return
+
+    if dprofile is not None:
+        from profile_phantompy import vconfigure_profile
+        vconfigure_profile(**dprofile)
+    from qasync import QEventLoop
+    app = oqapp()
     if bgui:
-        widget = Widget()
-        widget._app = app
+        widget = owidget(app)
         widget.show()
     else:
         widget = None
@@ -102,27 +409,43 @@ def iMain(largs):
     loop = QEventLoop(app)
     asyncio.set_event_loop(loop)
 
-    url = oargs.html_url
-    htmlfile = oargs.html_output
-    pdffile = oargs.html_output
-    jsfile = oargs.js_input
-    # run only starts the url loading
-    r = Render(app,
-               do_print=True if pdffile else False,
-               do_save=True if htmlfile else False)
-    uri = url.strip()
-    r.run(uri, pdffile, htmlfile, jsfile)
-    LOG.debug(f"{r.percent} {app.lstart}")
-
-    LOG.info(f"queued {len(app.lstart)} urls")
+    if oargs.warm_cache:
+        lurls = [elt[0] for elt in lread_batch(oargs.warm_cache)]
+        loop.run_until_complete(awarm(app, lurls, oargs.concurrency))
+    if oargs.cache_info:
+        from profile_phantompy import dprofile_info
+        print(json.dumps(dprofile_info(), indent=2))
+    if not url and not oargs.batch_input and not oargs.server:
+        # only --warm_cache or --cache_info
+        return
 
-    task = loop.create_task(main(widget, app, 1))
+    if oargs.server:
+        from server_phantompy import serve
+        task = loop.create_task(serve(app, oargs.server, oargs.concurrency,
+                                      oargs.max_queue, dkw, dpool, dsched,
+                                      oargs.server_dir))
+    elif oargs.batch_input:
+        ljobs = lread_batch(oargs.batch_input, htmlfile, pdffile)
+        if bextract:
+            ljobs = [(elt[0], '', '') for elt in ljobs]
+        if journal:
+            ljobs = ljournal_pending(journal, ljobs, bextract)
+        LOG.info(f"queued {len(ljobs)} urls")
+        task = loop.create_task(batch(widget, app, ljobs, jsfile, oargs.concurrency,
+                                      dkw, dpool, dsched, journal, bextract))
+    else:
+        task = loop.create_task(main(widget, app, url, htmlfile, pdffile, jsfile,
+                                     dkw, bextract))
     loop.run_forever()
 
     # cancel remaining tasks and wait for them to complete
     task.cancel()
     tasks = asyncio.all_tasks()
     loop.run_until_complete(asyncio.gather(*tasks))
+    if journal:
+        journal.close()
+    if oargs.metrics_output:
+        vwrite_metrics(oargs.metrics_output)
 
 if __name__ == '__main__':
     iMain(sys.argv[1:])
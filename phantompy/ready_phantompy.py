@@ -0,0 +1,107 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+Page ready detection: the javascript that Render runs when no
+--js_input is given, which sends __PHANTOM_PY_DONE__ as soon as the
+chosen condition holds, or when itimeout ms have passed at the latest.
+
+Modes:
+  timeout   wait the full itimeout ms (the old fixed setTimeout)
+  load      document.readyState is complete
+  idle      load, and no fetch/XHR/subresource activity for iidle ms
+  quiet     load, and no DOM mutations for iidle ms
+  selector  the CSS selector sselector matches an element
+
+If the page has a phantompy_extract, from extract_phantompy, it is
+called instead when the page is ready.
+"""
+
+import json
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+lREADY_MODES = ['timeout', 'load', 'idle', 'quiet', 'selector']
+
+READY_JS = """
+(function(mode, timeout, idle, selector) {
+  var t0 = Date.now(), last = Date.now(), inflight = 0, sent = false;
+  function done(why) {
+    if (sent) return;
+    sent = true;
+    if (window.phantompy_extract) {
+      // see extract_phantompy
+      phantompy_extract(why);
+    } else if (window.phantompy_done) {
+      phantompy_done({ready: why});
+    } else {
+      console.log('__PHANTOM_PY_DONE__ ' + why);
+    }
+  }
+  setTimeout(function() { done('timeout'); }, timeout);
+  if (mode == 'timeout') return;
+  function loaded() { return document.readyState == 'complete'; }
+  if (mode == 'idle') {
+    if (window.fetch) {
+      var _fetch = window.fetch;
+      window.fetch = function() {
+        inflight++; last = Date.now();
+        return _fetch.apply(this, arguments).finally(function() {
+          inflight--; last = Date.now(); });
+      };
+    }
+    var _send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function() {
+      inflight++; last = Date.now();
+      this.addEventListener('loadend', function() {
+        inflight--; last = Date.now(); });
+      return _send.apply(this, arguments);
+    };
+    if (window.PerformanceObserver) {
+      try {
+        new PerformanceObserver(function() { last = Date.now(); })
+          .observe({entryTypes: ['resource']});
+      } catch (e) {}
+    }
+  }
+  if (mode == 'quiet' && window.MutationObserver) {
+    new MutationObserver(function() { last = Date.now(); })
+      .observe(document, {childList: true, subtree: true,
+                          attributes: true, characterData: true});
+  }
+  function check() {
+    if (sent) return;
+    var ok = false;
+    if (mode == 'load') {
+      ok = loaded();
+    } else if (mode == 'idle') {
+      ok = loaded() && inflight <= 0 && Date.now() - last >= idle;
+    } else if (mode == 'quiet') {
+      ok = loaded() && Date.now() - last >= idle;
+    } else if (mode == 'selector') {
+      ok = document.querySelector(selector) !== null;
+    }
+    if (ok) {
+      done(mode + ' ' + (Date.now() - t0));
+    } else {
+      setTimeout(check, Math.min(50, idle || 50));
+    }
+  }
+  check();
+})(%s, %d, %d, %s);
+"""
+
+def sready_js(smode='idle', itimeout=5000, iidle=500, sselector=''):
+    """Return the javascript that signals __PHANTOM_PY_DONE__ when the
+    page is ready according to smode, or after itimeout ms."""
+    if smode not in lREADY_MODES:
+        raise ValueError(f"unknown ready mode {smode} not in {lREADY_MODES}")
+    if smode == 'selector' and not sselector:
+        raise ValueError("ready mode selector needs a selector")
+    return READY_JS % (json.dumps(smode), int(itimeout), int(iidle),
+                       json.dumps(sselector))
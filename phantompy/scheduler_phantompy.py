@@ -0,0 +1,239 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+A scheduler in front of render for jobs on many hosts: it lets at most
+iconcurrency jobs run at once, at most ihost_concurrency of them on any
+one host, and starts jobs on a host no faster than frate a second with
+bursts of iburst (a token bucket per host, 0 for no limit).
+
+Waiting jobs go by priority, higher first, and among hosts with jobs of
+the same priority it takes turns, so one host with many jobs does not
+starve the others:
+
+    sched = Scheduler(iconcurrency=8, ihost_concurrency=2, frate=1.0)
+    async with sched.oslot(url, ipriority=0):
+        result = await render(url, ...)
+
+dstats gives the queue depth, the jobs in flight by host and the times
+jobs waited.
+"""
+
+import asyncio
+import collections
+import heapq
+import math
+import time
+from urllib.parse import urlparse
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+def shost_of(surl):
+    """The host jobs on surl are limited by, '' if it has none."""
+    try:
+        return (urlparse(surl).hostname or '').lower()
+    except ValueError:
+        return ''
+
+class Ticket:
+    """A job waiting in, or let go by, a Scheduler."""
+
+    def __init__(self, shost, ipriority, fqueued):
+        self.shost = shost
+        self.ipriority = ipriority
+        self.fqueued = fqueued
+        self.fstarted = None
+        self.bcancelled = False
+
+class _Slot:
+
+    def __init__(self, sched, surl, ipriority):
+        self._sched = sched
+        self._surl = surl
+        self._ipriority = ipriority
+        self._ticket = None
+
+    async def __aenter__(self):
+        self._ticket = await self._sched.acquire(self._surl, self._ipriority)
+        return self._ticket
+
+    async def __aexit__(self, *args):
+        self._sched.release(self._ticket)
+
+class Scheduler:
+
+    def __init__(self, iconcurrency=4, ihost_concurrency=0, frate=0.0, iburst=1):
+        self.iconcurrency = max(1, iconcurrency)
+        # 0 for no limit
+        self.ihost_concurrency = ihost_concurrency
+        self.frate = frate
+        self.iburst = max(1, iburst)
+        # host -> heap of (-priority, seq, ticket, future)
+        self._dwaiting = {}
+        # the hosts with waiting jobs, in the order they take turns
+        self._lhosts = []
+        self._slast = None
+        # host -> jobs in flight
+        self._dinflight = {}
+        # host -> [tokens, time]
+        self._dbuckets = {}
+        self._iseq = 0
+        self._iwaiting = 0
+        self._iinflight = 0
+        self._ohandle = None
+        self._fwake = None
+        self.idispatched = 0
+        # the last waits in seconds, for the percentiles
+        self._lwaits = collections.deque(maxlen=1000)
+        self._fwaited = 0.0
+
+    def qsize(self):
+        """The number of jobs waiting."""
+        return self._iwaiting
+
+    def oslot(self, surl, ipriority=0):
+        """An async context manager holding a slot for a job on surl."""
+        return _Slot(self, surl, ipriority)
+
+    async def acquire(self, surl, ipriority=0):
+        """Wait for the turn of a job on surl and return its Ticket,
+        which must be given back with release."""
+        loop = asyncio.get_event_loop()
+        ticket = Ticket(shost_of(surl), ipriority, time.monotonic())
+        fut = loop.create_future()
+        if ticket.shost not in self._dwaiting:
+            self._dwaiting[ticket.shost] = []
+            self._lhosts.append(ticket.shost)
+        self._iseq += 1
+        heapq.heappush(self._dwaiting[ticket.shost],
+                       (-ipriority, self._iseq, ticket, fut))
+        self._iwaiting += 1
+        self._vdispatch()
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # let go just as it was cancelled
+                self.release(fut.result())
+            elif not ticket.bcancelled:
+                ticket.bcancelled = True
+                self._iwaiting -= 1
+            raise
+
+    def release(self, ticket):
+        """The job of ticket is done: let the next one go."""
+        self._iinflight -= 1
+        self._dinflight[ticket.shost] -= 1
+        if not self._dinflight[ticket.shost]:
+            del self._dinflight[ticket.shost]
+        self._vdispatch()
+
+    def _fdelay(self, shost, now):
+        """Seconds until shost has a token, refilling its bucket."""
+        if self.frate <= 0:
+            return 0.0
+        bucket = self._dbuckets.get(shost)
+        if bucket is None:
+            bucket = self._dbuckets[shost] = [float(self.iburst), now]
+        bucket[0] = min(float(self.iburst), bucket[0] + (now - bucket[1]) * self.frate)
+        bucket[1] = now
+        if bucket[0] >= 1.0:
+            return 0.0
+        return (1.0 - bucket[0]) / self.frate
+
+    def _tpick(self, now):
+        """Return the next (entry, 0) to let go, or (None, seconds until a
+        token could let one go, 0 if none)."""
+        n = len(self._lhosts)
+        istart = 0
+        if self._slast in self._lhosts:
+            istart = self._lhosts.index(self._slast) + 1
+        best = None
+        fdelay = 0.0
+        for i in range(n):
+            shost = self._lhosts[(istart + i) % n]
+            heap = self._dwaiting[shost]
+            while heap and heap[0][2].bcancelled:
+                heapq.heappop(heap)
+            if not heap:
+                continue
+            if self.ihost_concurrency and \
+               self._dinflight.get(shost, 0) >= self.ihost_concurrency:
+                continue
+            f = self._fdelay(shost, now)
+            if f > 0:
+                fdelay = f if not fdelay else min(fdelay, f)
+                continue
+            # the first host in turn wins a tie
+            if best is None or heap[0][0] < best[0]:
+                best = (heap[0][0], shost)
+        entry = None
+        if best is not None:
+            entry = heapq.heappop(self._dwaiting[best[1]])
+            self._slast = best[1]
+        for elt in self._lhosts:
+            if not self._dwaiting[elt]:
+                del self._dwaiting[elt]
+        self._lhosts = [elt for elt in self._lhosts if elt in self._dwaiting]
+        if entry is None:
+            return None, fdelay
+        shost = best[1]
+        if self.frate > 0:
+            self._dbuckets[shost][0] -= 1.0
+        return entry, 0.0
+
+    def _vdispatch(self):
+        now = time.monotonic()
+        fdelay = 0.0
+        while self._iinflight < self.iconcurrency and self._iwaiting:
+            entry, fdelay = self._tpick(now)
+            if entry is None:
+                break
+            ticket, fut = entry[2], entry[3]
+            self._iwaiting -= 1
+            self._iinflight += 1
+            self._dinflight[ticket.shost] = self._dinflight.get(ticket.shost, 0) + 1
+            self.idispatched += 1
+            ticket.fstarted = now
+            fwait = now - ticket.fqueued
+            self._lwaits.append(fwait)
+            self._fwaited += fwait
+            fut.set_result(ticket)
+        if fdelay > 0:
+            # wake up when the next token comes
+            fwake = now + fdelay
+            if self._ohandle is None or fwake < self._fwake:
+                if self._ohandle is not None:
+                    self._ohandle.cancel()
+                self._fwake = fwake
+                self._ohandle = asyncio.get_event_loop().call_later(fdelay, self._on_timer)
+
+    def _on_timer(self):
+        self._ohandle = None
+        self._vdispatch()
+
+    def dstats(self):
+        lwaits = sorted(self._lwaits)
+        dwait = dict(count=self.idispatched,
+                     mean=self._fwaited / self.idispatched if self.idispatched else 0.0,
+                     max=lwaits[-1] if lwaits else 0.0)
+        for ip in (50, 95):
+            if lwaits:
+                i = max(0, min(len(lwaits) - 1, math.ceil(ip / 100.0 * len(lwaits)) - 1))
+                dwait[f"p{ip}"] = lwaits[i]
+        dhosts = {}
+        for shost, heap in self._dwaiting.items():
+            iqueued = len([elt for elt in heap if not elt[2].bcancelled])
+            if iqueued or shost in self._dinflight:
+                dhosts[shost] = dict(queued=iqueued,
+                                     inflight=self._dinflight.get(shost, 0))
+        return dict(queued=self._iwaiting,
+                    inflight=self._iinflight,
+                    dispatched=self.idispatched,
+                    hosts=dhosts,
+                    wait=dwait)
@@ -0,0 +1,140 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+The javascript of a job as a QWebEngineScript of its page, instead of
+a runJavaScript once the whole page has loaded.
+
+The injection points are:
+  creation  at document creation, before the page's own scripts
+  ready     when the DOM is ready (DOMContentLoaded)
+  deferred  when the page has loaded, or 500 ms after the DOM is ready
+  load      not injected: run with runJavaScript after loadFinished
+
+and the worlds are main, the page's own, or isolated, where the page's
+scripts can not see or tamper with ours, though the DOM is shared. In
+the isolated world phantompy_done hands its data to the bridge in the
+main world through a DOM attribute and event.
+
+Script files are read again only when their mtime or size changes, and
+the QWebEngineScripts are made once for each contents, point and world,
+keeping the last iMAX_SCRIPTS, as a server can be sent any contents.
+"""
+
+import collections
+import hashlib
+import importlib
+import os
+
+from qasync import QtModuleName
+
+try:
+    QWebEngineScript = importlib.import_module(QtModuleName + ".QtWebEngineCore", package=QtModuleName).QWebEngineScript
+except (ImportError, AttributeError):
+    QWebEngineScript = importlib.import_module(QtModuleName + ".QtWebEngineWidgets", package=QtModuleName).QWebEngineScript
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+dINJECTION_POINTS = {'creation': QWebEngineScript.DocumentCreation,
+                     'ready': QWebEngineScript.DocumentReady,
+                     'deferred': QWebEngineScript.Deferred}
+lINJECTIONS = list(dINJECTION_POINTS) + ['load']
+dWORLDS = {'main': QWebEngineScript.MainWorld,
+           'isolated': QWebEngineScript.ApplicationWorld}
+
+# what the old runJavaScript of contentEditable did, for any injection point
+EDITABLE_JS = """
+(function() {
+  function editable() { document.documentElement.contentEditable = true; }
+  if (document.documentElement) { editable(); }
+  else { document.addEventListener('DOMContentLoaded', editable); }
+})();
+"""
+
+# phantompy_done in the isolated world: the bridge is in the main world,
+# and so is the console it watches for the magic string
+ISOLATED_JS = """
+window.phantompy_done = function(data) {
+  document.documentElement.setAttribute('data-phantompy-done',
+    JSON.stringify(data === undefined ? null : data));
+  document.dispatchEvent(new Event('phantompy_done'));
+};
+['log', 'info', 'warn', 'error'].forEach(function(level) {
+  var _log = console[level];
+  console[level] = function() {
+    if (Array.prototype.join.call(arguments, ' ').indexOf('__PHANTOM_PY_DONE__') >= 0) {
+      window.phantompy_done(null);
+    }
+    return _log.apply(console, arguments);
+  };
+});
+"""
+
+# path -> (mtime_ns, size, contents)
+_dFILES = {}
+# (sha256, injection, world) -> QWebEngineScript, the least recently used first
+_dSCRIPTS = collections.OrderedDict()
+iMAX_SCRIPTS = 64
+
+def sread_script(sfile):
+    """Return the contents of the script sfile, read again only when its
+    mtime or size has changed."""
+    st = os.stat(sfile)
+    elt = _dFILES.get(sfile)
+    if elt is not None and elt[0] == st.st_mtime_ns and elt[1] == st.st_size:
+        return elt[2]
+    with open(sfile, 'rt') as ifd:
+        scontents = ifd.read()
+    _dFILES[sfile] = (st.st_mtime_ns, st.st_size, scontents)
+    LOG.debug(f"scripts: read {sfile}")
+    return scontents
+
+def oscript(scontents, sinjection='deferred', sworld='isolated'):
+    """Return the QWebEngineScript running scontents at sinjection in
+    sworld, made once for each."""
+    if sinjection not in dINJECTION_POINTS:
+        raise ValueError(f"unknown injection point {sinjection} not in {list(dINJECTION_POINTS)}")
+    if sworld not in dWORLDS:
+        raise ValueError(f"unknown world {sworld} not in {list(dWORLDS)}")
+    key = (hashlib.sha256(scontents.encode('utf-8')).hexdigest(), sinjection, sworld)
+    if key in _dSCRIPTS:
+        _dSCRIPTS.move_to_end(key)
+    else:
+        script = QWebEngineScript()
+        script.setName('phantompy_job_' + key[0][:16])
+        ssource = EDITABLE_JS
+        if sworld == 'isolated':
+            ssource += ISOLATED_JS
+        script.setSourceCode(ssource + scontents)
+        script.setInjectionPoint(dINJECTION_POINTS[sinjection])
+        script.setWorldId(dWORLDS[sworld])
+        script.setRunsOnSubFrames(False)
+        _dSCRIPTS[key] = script
+        if len(_dSCRIPTS) > iMAX_SCRIPTS:
+            # pages that still have it installed keep their own reference
+            _dSCRIPTS.popitem(last=False)
+    return _dSCRIPTS[key]
+
+def vinstall_job_script(page, scontents, sinjection='deferred', sworld='isolated'):
+    """Make scontents the job script of page, replacing the one of its
+    last job unless it is the same."""
+    script = oscript(scontents, sinjection, sworld)
+    old = getattr(page, '_ojob_script', None)
+    if old is script:
+        return
+    if old is not None:
+        page.scripts().remove(old)
+    page.scripts().insert(script)
+    page._ojob_script = script
+
+def vremove_job_script(page):
+    """Remove the job script of page, if any."""
+    old = getattr(page, '_ojob_script', None)
+    if old is not None:
+        page.scripts().remove(old)
+        page._ojob_script = None
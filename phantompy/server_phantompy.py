@@ -0,0 +1,279 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+A long running render server that keeps the QApplication and a pool of
+pages warm, and takes jobs as lines of JSON over a Unix socket or a
+localhost TCP port:
+
+    {"id": 1, "url": "https://example.com", "html": "/tmp/1.html"}
+    {"id": 2, "html_contents": "<p>hi</p>", "pdf": "/tmp/2.pdf",
+     "js_contents": "phantompy_done(document.title)"}
+    {"cmd": "stats"}
+    {"cmd": "metrics"}
+    {"cmd": "drain"}
+
+Job keys are url, priority, html_contents, js (a file), js_contents, html
+and pdf (output files on the server), ready (the sready_js keywords), block
+(the Interceptor.configure keywords), save (the Render.run dsave),
+pdf_layout (the Render.run dpdf) and script (the Render.run djs).
+A pdf of - is answered as pdf_base64.
+The jobs are started by a Scheduler, higher priority first, taking
+turns between hosts.
+Each job is answered, when it is done, with a line holding its id and
+the RenderResult; the answers on a connection can come out of order.
+When imax_queue jobs are queued or running a job is answered at once
+with the status busy. On SIGTERM or SIGINT, or a drain command, the
+server stops accepting jobs, finishes the queued ones and exits.
+
+    echo '{"url": "example.com", "html": "/tmp/e.html"}' | \\
+        socat - UNIX-CONNECT:/tmp/phantompy.sock
+
+The trust model: a job can read its js file, write its html and pdf
+files and load file urls, all as the user running the server, and
+what the page sees comes back in data. So whoever can connect must be
+trusted with those files. The Unix socket is made readable and
+writable by its owner only. With sdir (--server_dir) the js, html and
+pdf paths of jobs, relative or absolute, must be inside sdir, and file
+urls are refused, as a page loaded from a file can read any other file,
+or the job is refused. A TCP port can be reached by any local user, so
+it needs sdir.
+"""
+
+import asyncio
+import base64
+import io
+import json
+import os
+import signal
+
+from urllib.parse import urlsplit
+
+from metrics_phantompy import METRICS
+from qasync_phantompy import render, sfromuserinput
+from scheduler_phantompy import Scheduler
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+# the job keys that are strings and those that are dicts
+lSTR_KEYS = ['url', 'js', 'html', 'pdf', 'js_contents', 'html_contents']
+lDICT_KEYS = ['ready', 'block', 'save', 'pdf_layout', 'script']
+
+def spath_in(spath, sdir):
+    """Return spath, taken as relative to sdir if there is one, or
+    raise ValueError if it is not inside sdir."""
+    if not spath or not sdir:
+        return spath
+    sreal = os.path.realpath(os.path.join(sdir, spath))
+    if os.path.commonpath([sreal, sdir]) != sdir:
+        raise ValueError(f"{spath} is not in the server directory")
+    return sreal
+
+def tjob_paths(djob, sdir=''):
+    """Return the js, html and pdf paths of djob, checked against sdir,
+    the realpath of the server directory or '', or raise ValueError if a
+    key of djob has the wrong type or it breaks the trust model."""
+    for key in lSTR_KEYS:
+        if key in djob and not isinstance(djob[key], str):
+            raise ValueError(f"{key} is not a string")
+    for key in lDICT_KEYS:
+        if key in djob and not isinstance(djob[key], dict):
+            raise ValueError(f"{key} is not an object")
+    surl = djob.get('url', '')
+    if surl and sdir and urlsplit(sfromuserinput(surl)).scheme.lower() == 'file':
+        raise ValueError(f"{surl} is a file url")
+    js = spath_in(djob.get('js', ''), sdir)
+    html = spath_in(djob.get('html', ''), sdir)
+    pdf = djob.get('pdf', '')
+    if pdf != '-':
+        pdf = spath_in(pdf, sdir)
+    return js, html, pdf
+
+class Server:
+
+    def __init__(self, app, iconcurrency=4, imax_queue=100, dkw=None, dpool=None,
+                 dsched=None, sdir=''):
+        self._app = app
+        # the directory the files of jobs must be in, '' for anywhere
+        self.sdir = os.path.realpath(sdir) if sdir else ''
+        self.iconcurrency = max(1, iconcurrency)
+        self.imax_queue = imax_queue
+        # the default keywords for Render.run
+        self.dkw = dkw or {}
+        from pool_phantompy import RenderPool
+        self.pool = RenderPool(app, isize=self.iconcurrency, **(dpool or {}))
+        self.sched = Scheduler(self.iconcurrency, **(dsched or {}))
+        self._server = None
+        # the tasks of the jobs accepted and not yet done
+        self._stasks = set()
+        self._bdraining = False
+        self.iaccepted = 0
+        self.irejected = 0
+        self.idone = 0
+
+    async def start(self, saddress):
+        """Listen on saddress, a socket path or host:port."""
+        if ':' in saddress and not saddress.startswith('/'):
+            if not self.sdir:
+                raise ValueError("a TCP server needs a directory for the files of jobs")
+            shost, sport = saddress.rsplit(':', 1)
+            self.pool.warm()
+            self._server = await asyncio.start_server(self._handle,
+                                                      shost or '127.0.0.1',
+                                                      int(sport))
+        else:
+            if os.path.exists(saddress):
+                os.unlink(saddress)
+            self.pool.warm()
+            iumask = os.umask(0o177)
+            try:
+                self._server = await asyncio.start_unix_server(self._handle,
+                                                               saddress)
+            finally:
+                os.umask(iumask)
+        LOG.info(f"server: listening on {saddress}")
+
+    def dstats(self):
+        return dict(queued=self.sched.qsize(),
+                    accepted=self.iaccepted,
+                    rejected=self.irejected,
+                    done=self.idone,
+                    draining=self._bdraining,
+                    pool=self.pool.dstats(),
+                    scheduler=self.sched.dstats())
+
+    async def _reply(self, writer, d):
+        writer.write(json.dumps(d).encode('utf-8') + b'\n')
+        try:
+            await writer.drain()
+        except ConnectionError as e:
+            LOG.debug(f"server: client went away {e}")
+
+    async def _handle(self, reader, writer):
+        ltasks = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                djob = json.loads(line)
+                assert type(djob) == dict, djob
+            except (ValueError, AssertionError) as e:
+                await self._reply(writer, dict(status='error', error=f"bad job {e}"))
+                continue
+            cmd = djob.get('cmd')
+            if cmd == 'stats':
+                await self._reply(writer, dict(id=djob.get('id'), stats=self.dstats()))
+                continue
+            if cmd == 'metrics':
+                await self._reply(writer, dict(id=djob.get('id'),
+                                               metrics=METRICS.dsnapshot(),
+                                               prometheus=METRICS.sprometheus()))
+                continue
+            if cmd == 'drain':
+                asyncio.ensure_future(self.drain())
+                await self._reply(writer, dict(id=djob.get('id'), status='draining'))
+                continue
+            if self._bdraining or len(self._stasks) >= self.imax_queue:
+                self.irejected += 1
+                await self._reply(writer, dict(id=djob.get('id'), status='busy'))
+                continue
+            self.iaccepted += 1
+            task = asyncio.ensure_future(self._work(djob))
+            self._stasks.add(task)
+            task.add_done_callback(self._stasks.discard)
+            ltasks.append(asyncio.ensure_future(self._answer(writer, djob, task)))
+        # let the jobs of this connection finish before closing it
+        if ltasks:
+            await asyncio.gather(*ltasks, return_exceptions=True)
+        writer.close()
+
+    async def _answer(self, writer, djob, fut):
+        d = await fut
+        d['id'] = djob.get('id')
+        await self._reply(writer, d)
+
+    async def _work(self, djob):
+        """Run djob when the scheduler lets it and return its answer."""
+        try:
+            ipriority = int(djob.get('priority', 0))
+        except (TypeError, ValueError):
+            ipriority = 0
+        try:
+            js, html, pdf = tjob_paths(djob, self.sdir)
+        except (AttributeError, TypeError, ValueError) as e:
+            LOG.warn(f"server: refused {djob.get('url', '')} {e}")
+            self.irejected += 1
+            return dict(uri=str(djob.get('url', '')), status='error', error=str(e))
+        ticket = await self.sched.acquire(djob.get('url', ''), ipriority)
+        try:
+            kw = dict(self.dkw)
+            if 'ready' in djob:
+                kw['dready'] = djob['ready']
+            if 'block' in djob:
+                kw['dintercept'] = djob['block']
+            if 'save' in djob:
+                kw['dsave'] = djob['save']
+            if 'pdf_layout' in djob:
+                kw['dpdf'] = djob['pdf_layout']
+            if 'script' in djob:
+                kw['djs'] = djob['script']
+            # a pdf of - comes back in the answer, not to our stdout
+            if pdf == '-':
+                pdf = io.BytesIO()
+            for key in ['js_contents', 'html_contents']:
+                if key in djob:
+                    kw[key] = djob[key]
+            result = await render(djob.get('url', ''),
+                                  js=js,
+                                  html=html,
+                                  pdf=pdf,
+                                  app=self._app, pool=self.pool,
+                                  fqueued=ticket.fqueued, **kw)
+            d = result.asdict()
+            if djob.get('pdf') == '-' and result.pdf_bytes is not None:
+                d['pdf_base64'] = base64.b64encode(result.pdf_bytes).decode('ascii')
+            return d
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOG.exception(f"server: job {djob}")
+            return dict(uri=djob.get('url', ''), status='error', error=str(e))
+        finally:
+            self.idone += 1
+            self.sched.release(ticket)
+
+    async def drain(self):
+        """Stop accepting jobs, finish the queued ones, then exit the app."""
+        if self._bdraining:
+            return
+        self._bdraining = True
+        LOG.info(f"server: draining {len(self._stasks)} jobs")
+        self._server.close()
+        while self._stasks:
+            await asyncio.gather(*list(self._stasks), return_exceptions=True)
+        self.pool.close()
+        LOG.info(f"server: drained {self.dstats()}")
+        self._app.exit()
+
+async def serve(app, saddress, iconcurrency=4, imax_queue=100, dkw=None,
+                dpool=None, dsched=None, sdir=''):
+    """Run a Server on saddress until it is drained; sdir is the
+    directory the files of jobs must be in, see the trust model."""
+    server = Server(app, iconcurrency=iconcurrency, imax_queue=imax_queue, dkw=dkw,
+                    dpool=dpool, dsched=dsched, sdir=sdir)
+    await server.start(saddress)
+    loop = asyncio.get_event_loop()
+    def on_signal(*args):
+        loop.call_soon_threadsafe(lambda: asyncio.ensure_future(server.drain()))
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(sig, on_signal)
+    # python signal handlers only run when python code does,
+    # so wake up now and then while Qt has the loop
+    while not server._bdraining:
+        await asyncio.sleep(0.5)
@@ -0,0 +1,153 @@
+#!/usr/local/bin/python3.sh
+# -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
+
+"""
+Render a batch across several processes, each with its own QApplication,
+QEventLoop and RenderPool, so that the Python side of rendering is not
+bound to one core.
+
+The jobs go into one shared queue that the workers pull from, so a slow
+url only holds up the worker that has it. Each worker writes its HTML and
+PDF outputs straight to their files and sends back only the small
+RenderResult dict over a pipe, so the payloads are never pickled.
+As it takes each job it sends a small start dict, for the journal and so
+that the jobs of a worker that dies are answered as crashed.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+from multiprocessing.connection import wait
+
+global LOG
+import logging
+import warnings
+
+warnings.filterwarnings('ignore')
+LOG = logging.getLogger()
+
+def vworker(iworker, qjobs, oconn, jsfile='', iconcurrency=4, dkw=None,
+            log_level=20, dprofile=None, dpool=None, dsched=None):
+    """The body of a worker process: render jobs from qjobs until a
+    None for each of its iconcurrency slots, sending results to oconn.
+    dprofile are the vconfigure_profile keywords, if any, dpool the
+    RenderPool keywords and dsched the Scheduler keywords."""
+    # imported here so that the supervisor never loads Qt
+    from qasync import QEventLoop
+
+    from pool_phantompy import RenderPool
+    from qasync_phantompy import oqapp, render
+    from scheduler_phantompy import Scheduler
+    from support_phantompy import vsetup_logging
+
+    # the worker only renders, so never let its log hold it up
+    vsetup_logging(log_level, logfile='', stream=sys.stderr, bqueue=True)
+    if dprofile is not None:
+        from profile_phantompy import vconfigure_profile
+        dprofile = dict(dprofile)
+        if dprofile.get('sdir'):
+            # chromium wants a profile directory to itself
+            dprofile['sdir'] = os.path.join(dprofile['sdir'], f"worker-{iworker}")
+        vconfigure_profile(**dprofile)
+    app = oqapp()
+    loop = QEventLoop(app)
+    asyncio.set_event_loop(loop)
+
+    async def work():
+        pool = RenderPool(app, isize=iconcurrency, **(dpool or {}))
+        pool.warm()
+        sched = Scheduler(iconcurrency, **(dsched or {}))
+
+        async def slot():
+            while True:
+                job = await loop.run_in_executor(None, qjobs.get)
+                if job is None:
+                    return
+                uri, htmlfile, pdffile = job
+                oconn.send(dict(event='start', uri=uri, worker=iworker))
+                async with sched.oslot(uri) as ticket:
+                    result = await render(uri, js=jsfile, html=htmlfile, pdf=pdffile,
+                                          app=app, pool=pool, fqueued=ticket.fqueued,
+                                          **(dkw or {}))
+                d = result.asdict()
+                d['worker'] = iworker
+                oconn.send(d)
+
+        try:
+            await asyncio.gather(*[slot() for i in range(iconcurrency)])
+        finally:
+            LOG.info(f"worker {iworker} pid={os.getpid()} {pool.dstats()}")
+            pool.close()
+            oconn.close()
+            app.exit()
+
+    loop.create_task(work())
+    loop.run_forever()
+
+def lrun_shards(ljobs, iprocs, jsfile='', iconcurrency=4, dkw=None,
+                log_level=20, on_result=None, dprofile=None, dpool=None,
+                dsched=None, on_start=None):
+    """Render ljobs of (url, htmlfile, pdffile) in iprocs worker processes
+    of iconcurrency pages each, and return the list of result dicts.
+    on_result is called with each result dict as soon as it arrives, and
+    on_start with a dict of uri and worker as each job starts."""
+    # fork and Qt do not mix
+    ctx = multiprocessing.get_context('spawn')
+    qjobs = ctx.Queue()
+    for elt in ljobs:
+        qjobs.put(tuple(elt))
+    for i in range(iprocs * iconcurrency):
+        qjobs.put(None)
+
+    lprocs = []
+    lconns = []
+    for i in range(iprocs):
+        rconn, wconn = ctx.Pipe(duplex=False)
+        p = ctx.Process(target=vworker,
+                        name=f"phantompy-{i}",
+                        args=(i, qjobs, wconn, jsfile, iconcurrency, dkw, log_level,
+                              dprofile, dpool, dsched))
+        p.start()
+        # so that recv sees EOF when the worker goes
+        wconn.close()
+        lprocs.append(p)
+        lconns.append(rconn)
+    LOG.info(f"started {iprocs} workers for {len(ljobs)} urls")
+    lconns_all = list(lconns)
+
+    lresults = []
+    # worker -> the uris it has taken and not answered
+    dstarted = {i: set() for i in range(iprocs)}
+    while lconns:
+        for conn in wait(lconns):
+            try:
+                d = conn.recv()
+            except EOFError:
+                lconns.remove(conn)
+                i = lconns_all.index(conn)
+                for uri in sorted(dstarted[i]):
+                    LOG.warn(f"worker {i} died with {uri}")
+                    d = dict(uri=uri, status='crashed', val=2, outputs={},
+                             timings={}, data=None, cached=False, sizes={},
+                             requests={}, retries=0, console=[], worker=i)
+                    lresults.append(d)
+                    if on_result is not None:
+                        on_result(d)
+                dstarted[i].clear()
+                continue
+            if d.get('event') == 'start':
+                dstarted[d['worker']].add(d['uri'])
+                if on_start is not None:
+                    on_start(d)
+                continue
+            dstarted[d['worker']].discard(d['uri'])
+            lresults.append(d)
+            if on_result is not None:
+                on_result(d)
+
+    for p in lprocs:
+        p.join()
+        if p.exitcode != 0:
+            LOG.warn(f"worker {p.name} exited with {p.exitcode}")
+    return lresults
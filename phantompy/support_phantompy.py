@@ -2,17 +2,12 @@
 # -*-mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*
 
 import argparse
+import atexit
+import logging.handlers
 import os
+import queue
 import sys
 
-try:
-    if 'COLOREDLOGS_LEVEL_STYLES' not in os.environ:
-        os.environ['COLOREDLOGS_LEVEL_STYLES'] = 'spam=22;debug=28;verbose=34;notice=220;warning=202;success=118,bold;error=124;critical=background=red'
-    # https://pypi.org/project/coloredlogs/
-    import coloredlogs
-except ImportError:
-    coloredlogs = False
-
 global LOG
 import logging
 import warnings
@@ -20,9 +15,59 @@ import warnings
 warnings.filterwarnings('ignore')
 LOG = logging.getLogger()
 
-def vsetup_logging(log_level, logfile='', stream=sys.stdout):
+def ocoloredlogs():
+    """Return the coloredlogs module, or False: imported when logging is
+    set up, not when the arguments are parsed."""
+    try:
+        if 'COLOREDLOGS_LEVEL_STYLES' not in os.environ:
+            os.environ['COLOREDLOGS_LEVEL_STYLES'] = 'spam=22;debug=28;verbose=34;notice=220;warning=202;success=118,bold;error=124;critical=background=red'
+        # https://pypi.org/project/coloredlogs/
+        import coloredlogs
+    except ImportError:
+        coloredlogs = False
+    return coloredlogs
+
+# the thread writing the records queued by vqueue_logging
+_oLISTENER = None
+
+def vqueue_logging():
+    """Move the handlers of the root logger to a thread fed by a queue,
+    so that logging from the Qt thread never waits on a stream or file."""
+    global _oLISTENER
+    if _oLISTENER is not None:
+        return
+    lhandlers = list(LOG.handlers)
+    oqueue = queue.Queue(-1)
+    for elt in lhandlers:
+        LOG.removeHandler(elt)
+    LOG.addHandler(logging.handlers.QueueHandler(oqueue))
+    _oLISTENER = logging.handlers.QueueListener(oqueue, *lhandlers,
+                                                respect_handler_level=True)
+    _oLISTENER.start()
+    atexit.register(vstop_logging)
+
+def vstop_logging():
+    """Write out the queued records and give the handlers back to the
+    root logger."""
+    global _oLISTENER
+    if _oLISTENER is None:
+        return
+    olistener = _oLISTENER
+    _oLISTENER = None
+    olistener.stop()
+    for elt in list(LOG.handlers):
+        if isinstance(elt, logging.handlers.QueueHandler):
+            LOG.removeHandler(elt)
+    for elt in olistener.handlers:
+        LOG.addHandler(elt)
+
+def vsetup_logging(log_level, logfile='', stream=sys.stdout, bqueue=False):
+    """Log at log_level to stream and logfile; if bqueue the records are
+    written by a thread, see vqueue_logging."""
     global LOG
     add = True
+    vstop_logging()
+    coloredlogs = ocoloredlogs()
 
     # stem fucks up logging
     # from stem.util import log
@@ -80,38 +125,152 @@ def vsetup_logging(log_level, logfile='', stream=sys.stdout):
             'DEBUG': logging.DEBUG,
             'NOTSET': logging.NOTSET,
         }
+    if bqueue:
+        vqueue_logging()
 
-def omain_argparser(_=None):
+def ipid_rss_kb(ipid, skey='VmRSS'):
+    """Return the kB of skey in /proc/ipid/status, or 0."""
+    try:
+        with open(f"/proc/{ipid}/status", 'rt') as ifd:
+            for line in ifd:
+                if line.startswith(skey + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
 
+def scafile():
+    """Return the first Certificate Authority file that OpenSSL knows of
+    and exists, or ''."""
     try:
         from OpenSSL import SSL
         lCAfs = SSL._CERTIFICATE_FILE_LOCATIONS
     except:
         lCAfs = []
-
-    CAfs = []
     for elt in lCAfs:
         if os.path.exists(elt):
-            CAfs.append(elt)
-    if not CAfs:
-        CAfs = ['']
+            return elt
+    return ''
+
+def omain_argparser(_=None):
 
     parser = argparse.ArgumentParser(add_help=True,
                                      epilog=__doc__)
+    # the default is looked up by scafile when it is needed,
+    # as importing OpenSSL slows down every start
     parser.add_argument('--https_cafile', type=str,
                         help="Certificate Authority file (in PEM) (unused)",
-                        default=CAfs[0])
+                        default='')
     parser.add_argument('--log_level', type=int, default=20,
                         help="10=debug 20=info 30=warn 40=error")
     parser.add_argument('--js_input', type=str, default='',
                         help="Operate on the HTML file with javascript")
+    parser.add_argument('--js_inject', type=str, default='deferred',
+                        choices=['creation', 'ready', 'deferred', 'load'],
+                        help="When --js_input runs: at document creation, DOM ready, after the load (deferred), or after loadFinished with runJavaScript (load)")
+    parser.add_argument('--js_world', type=str, default='isolated',
+                        choices=['main', 'isolated'],
+                        help="Run --js_input in the page's own javascript world or an isolated one")
+    parser.add_argument('--extract', type=str, default='',
+                        help="Javascript function or JSON map of CSS selectors (or a file of either) to run when the page is ready: print its result as a line of JSON for each url instead of writing outputs")
+    parser.add_argument('--ready', type=str, default='idle',
+                        choices=['timeout', 'load', 'idle', 'quiet', 'selector'],
+                        help="When the page is done if there is no --js_input")
+    parser.add_argument('--ready_timeout', type=int, default=5000,
+                        help="Most ms to wait for the page to be ready")
+    parser.add_argument('--ready_idle', type=int, default=500,
+                        help="ms without network or DOM activity for idle or quiet")
+    parser.add_argument('--ready_selector', type=str, default='',
+                        help="CSS selector to wait for with --ready selector")
+    parser.add_argument('--console_lines', type=int, default=0,
+                        help="Keep the last N console messages of each page on its result instead of logging them")
+    parser.add_argument('--log_queue', default=False, action='store_true',
+                        help="Write the log from a thread, so a slow stderr or disk does not hold up rendering")
+    parser.add_argument('--console', default=False, action='store_true',
+                        help="Log the page's console messages at debug level")
+    parser.add_argument('--block_profile', type=str, default='none',
+                        choices=['none', 'html-only', 'no-media', 'allowlist-hosts'],
+                        help="Which subresources of the page not to load")
+    parser.add_argument('--block', type=str, action='append', default=[],
+                        help="Glob, or re:regexp, of urls not to load (repeatable)")
+    parser.add_argument('--allow_hosts', type=str, default='',
+                        help="Comma separated hosts for --block_profile allowlist-hosts")
     parser.add_argument('--html_output', type=str, default='',
                         help="Write loaded and javascripted result to a HTML file")
+    parser.add_argument('--html_format', type=str, default='html',
+                        choices=['html', 'single', 'complete', 'mhtml'],
+                        help="How to save the html: the DOM from Python, or written by Chromium, with subresources for complete and mhtml")
+    parser.add_argument('--html_compress', type=str, default='none',
+                        choices=['none', 'gzip', 'zstd'],
+                        help="Compress the html output of --html_format html")
     parser.add_argument('--pdf_output', type=str, default='',
                         help="Write loaded and javascripted result to a PDF file")
-    parser.add_argument('--show_gui', type=bool, default=False, store_action=True,
+    parser.add_argument('--pdf_paper', type=str, default='A4',
+                        choices=['A3', 'A4', 'A5', 'B4', 'B5', 'Letter', 'Legal', 'Tabloid', 'Executive'],
+                        help="Paper size of the pdf")
+    parser.add_argument('--pdf_margins', type=str, default='10',
+                        help="Margins of the pdf in mm: one number, or left,top,right,bottom")
+    parser.add_argument('--pdf_orientation', type=str, default='portrait',
+                        choices=['portrait', 'landscape'],
+                        help="Orientation of the pdf")
+    parser.add_argument('--pdf_scale', type=float, default=1.0,
+                        help="Zoom the page by this before printing the pdf")
+    parser.add_argument('--show_gui', default=False, action='store_true',
                         help="show a progress meter that doesn't work")
-    parser.add_argument('html_url', type=str, nargs='?',
-                        required=True,
-                        help='html file or url')
+    parser.add_argument('--batch_input', type=str, default='',
+                        help="File of lines: url [html_output [pdf_output]] - for stdin")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Number of pages to render at once in batch mode")
+    parser.add_argument('--host_concurrency', type=int, default=0,
+                        help="Most pages at once on one host (0 for no limit)")
+    parser.add_argument('--host_rate', type=float, default=0.0,
+                        help="Most pages started a second on one host (0 for no limit)")
+    parser.add_argument('--host_burst', type=int, default=1,
+                        help="Pages that can be started at once on one host within --host_rate")
+    parser.add_argument('--cache_dir', type=str, default='',
+                        help="Directory of a cache of rendered outputs to reuse")
+    parser.add_argument('--cache_ttl', type=int, default=3600,
+                        help="Seconds a cached render stays good")
+    parser.add_argument('--cache_size', type=int, default=512,
+                        help="Most MB of the cache before the least used are removed")
+    parser.add_argument('--metrics_output', type=str, default='',
+                        help="Write job metrics at the end: Prometheus text, or a JSON line if .jsonl")
+    parser.add_argument('--profile_dir', type=str, default='',
+                        help="Directory to keep the browser's HTTP cache and storage in across runs")
+    parser.add_argument('--http_cache', type=str, default='disk',
+                        choices=['disk', 'memory', 'none'],
+                        help="Type of the browser's HTTP cache")
+    parser.add_argument('--http_cache_mb', type=int, default=0,
+                        help="Most MB of the browser's HTTP cache (0 for Qt's default)")
+    parser.add_argument('--cookies', type=str, default='allow',
+                        choices=['none', 'allow', 'force'],
+                        help="Which cookies to keep across runs")
+    parser.add_argument('--warm_cache', type=str, default='',
+                        help="File of urls to load first to fill the HTTP cache")
+    parser.add_argument('--cache_info', default=False, action='store_true',
+                        help="Print the browser profile and HTTP cache size as JSON")
+    parser.add_argument('--load_timeout', type=float, default=60,
+                        help="Seconds to load a page before the job times out (0 for none)")
+    parser.add_argument('--js_timeout', type=float, default=30,
+                        help="Seconds to run the javascript before the job times out (0 for none)")
+    parser.add_argument('--output_timeout', type=float, default=60,
+                        help="Seconds to save and print before the job times out (0 for none)")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="Times to load a page again if its renderer process dies")
+    parser.add_argument('--recycle_jobs', type=int, default=0,
+                        help="Replace a page after this many jobs (0 for never)")
+    parser.add_argument('--recycle_rss_mb', type=int, default=0,
+                        help="Replace a page when its renderer process is over this many MB (0 for never)")
+    parser.add_argument('--journal', type=str, default='',
+                        help="Append-only journal of a batch: a rerun skips the urls done")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Number of worker processes to shard a batch across")
+    parser.add_argument('--server', type=str, default='',
+                        help="Serve jobs as lines of JSON on a socket path or host:port")
+    parser.add_argument('--server_dir', type=str, default='',
+                        help="Directory the js, html and pdf files of --server jobs must be in, refusing file urls: needed for a TCP port")
+    parser.add_argument('--max_queue', type=int, default=100,
+                        help="Most jobs queued or running in --server mode before busy")
+    parser.add_argument('html_url', type=str, nargs='?', default='',
+                        help='html file or url (required unless --batch_input)')
     return parser
@@ -9,14 +9,18 @@
 
 import os
 import logging
+import sys
 from pytest import fixture
 
+# the modules import each other by their flat names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'phantompy'))
+
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
 )
 
 @fixture(scope="session")
 def application():
-    from phantompy.qasync_phantompy import QApplication
+    from qasync_phantompy import oqapp
 
-    return QApplication([])
+    return oqapp([])
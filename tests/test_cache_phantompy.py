@@ -0,0 +1,161 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# the RenderCache on its own, with literal keys as skey needs Qt
+
+import os
+import time
+
+from cache_phantompy import RenderCache
+
+class FakeRender:
+    """What RenderCache uses of a Render."""
+
+    def __init__(self, uri, sfile=''):
+        self.uri = uri
+        self.ijobs = 1
+        self.data = {'title': uri}
+        self.sfile = sfile
+        self.lcalls = []
+
+    def oresult(self, val):
+        class Result:
+            outputs = {'html': self.sfile} if self.sfile else {}
+        return Result()
+
+    def _cached(self, skey, meta):
+        self.lcalls.append(('cached', meta['data']))
+
+    def _exit(self, val, status=None):
+        self.lcalls.append(('exit', val))
+
+    def _vload(self):
+        self.lcalls.append(('load',))
+
+def sput(cache, tmp_path, skey, icount=10):
+    sfile = str(tmp_path / (skey + '.html'))
+    with open(sfile, 'wt') as ofd:
+        ofd.write('x' * icount)
+    cache.vput(skey, 'http://' + skey, {'html': sfile}, {'k': skey})
+    return sfile
+
+def test_put_get(tmp_path):
+    cache = RenderCache(str(tmp_path / 'cache'))
+    sput(cache, tmp_path, 'aa11')
+    meta = cache.dget('aa11')
+    assert meta['data'] == {'k': 'aa11'}
+    with open(cache.sfile('aa11', meta, 'html'), 'rt') as ifd:
+        assert ifd.read() == 'x' * 10
+    assert cache.dget('bb22') is None
+    # the index is read back from disk
+    assert RenderCache(str(tmp_path / 'cache')).dget('aa11') is not None
+
+def test_ttl(tmp_path):
+    cache = RenderCache(str(tmp_path / 'cache'), ittl=10)
+    sput(cache, tmp_path, 'aa11')
+    meta = cache.dget('aa11')
+    meta['created'] = time.time() - 100
+    cache._vwrite_meta(cache._sentry('aa11'), meta)
+    assert cache.dget('aa11') is None
+    assert not os.path.exists(cache._sentry('aa11'))
+
+def test_missing_output(tmp_path):
+    cache = RenderCache(str(tmp_path / 'cache'))
+    sput(cache, tmp_path, 'aa11')
+    os.unlink(cache.sfile('aa11', cache.dget('aa11'), 'html'))
+    assert cache.dget('aa11') is None
+
+def test_lru(tmp_path):
+    cache = RenderCache(str(tmp_path / 'cache'), isize=25)
+    sput(cache, tmp_path, 'aa11')
+    time.sleep(0.01)
+    sput(cache, tmp_path, 'bb22')
+    time.sleep(0.01)
+    # used last, so kept over bb22
+    assert cache.dget('aa11') is not None
+    time.sleep(0.01)
+    sput(cache, tmp_path, 'cc33')
+    assert cache.dget('bb22') is None
+    assert cache.dget('aa11') is not None
+    assert cache.dget('cc33') is not None
+    assert cache.dstats()['bytes'] <= 25
+
+def test_single_flight(tmp_path):
+    cache = RenderCache(str(tmp_path / 'cache'))
+    sfile = str(tmp_path / 'out.html')
+    with open(sfile, 'wt') as ofd:
+        ofd.write('<html></html>')
+    first = FakeRender('http://a/', sfile)
+    second = FakeRender('http://a/')
+    reset = FakeRender('http://a/')
+    assert cache.bjoin('aa11', first) is False
+    assert cache.bjoin('aa11', second) is True
+    assert cache.bjoin('aa11', reset) is True
+    # reused for another job since it joined
+    reset.ijobs += 1
+    cache.vleave('aa11', first, 0)
+    assert second.lcalls == [('cached', {'title': 'http://a/'})]
+    assert reset.lcalls == []
+    assert cache.dstats()['joined'] == 2
+    # now it is a hit
+    third = FakeRender('http://a/')
+    assert cache.bjoin('aa11', third) is True
+    assert third.lcalls == [('cached', {'title': 'http://a/'})]
+
+def test_single_flight_failed(tmp_path):
+    cache = RenderCache(str(tmp_path / 'cache'))
+    first = FakeRender('http://a/')
+    second = FakeRender('http://a/')
+    cache.bjoin('aa11', first)
+    cache.bjoin('aa11', second)
+    cache.vleave('aa11', first, 1)
+    assert second.lcalls == [('exit', 1)]
+
+def test_single_flight_not_kept(tmp_path):
+    # an output bigger than the cache is evicted at once, so the
+    # waiters render it themselves instead of ending ok without it
+    cache = RenderCache(str(tmp_path / 'cache'), isize=5)
+    sfile = str(tmp_path / 'out.html')
+    with open(sfile, 'wt') as ofd:
+        ofd.write('x' * 10)
+    first = FakeRender('http://a/', sfile)
+    second = FakeRender('http://a/')
+    cache.bjoin('aa11', first)
+    cache.bjoin('aa11', second)
+    cache.vleave('aa11', first, 0)
+    assert second.lcalls == [('load',)]
+
+def test_waiter_leaves(tmp_path):
+    # a waiter that ends or is reset leaves the owner rendering
+    cache = RenderCache(str(tmp_path / 'cache'))
+    sfile = str(tmp_path / 'out.html')
+    with open(sfile, 'wt') as ofd:
+        ofd.write('<html></html>')
+    first = FakeRender('http://a/', sfile)
+    second = FakeRender('http://a/')
+    third = FakeRender('http://a/')
+    cache.bjoin('aa11', first)
+    cache.bjoin('aa11', second)
+    cache.bjoin('aa11', third)
+    cache.vleave('aa11', second, -1)
+    assert cache.bjoin('aa11', FakeRender('http://a/')) is True
+    cache.vleave('aa11', first, 0)
+    assert second.lcalls == []
+    assert third.lcalls == [('cached', {'title': 'http://a/'})]
+
+def test_waiter_error(tmp_path):
+    # a waiter that fails is ended and the others still answered
+    cache = RenderCache(str(tmp_path / 'cache'))
+    first = FakeRender('http://a/')
+    second = FakeRender('http://a/')
+    third = FakeRender('http://a/')
+    def _exit(val, status=None):
+        if status is None:
+            raise OSError('disk full')
+        second.lcalls.append(('exit', val))
+    second._exit = _exit
+    cache.bjoin('aa11', first)
+    cache.bjoin('aa11', second)
+    cache.bjoin('aa11', third)
+    cache.vleave('aa11', first, 1)
+    assert second.lcalls == [('exit', 1)]
+    assert third.lcalls == [('exit', 1)]
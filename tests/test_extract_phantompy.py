@@ -0,0 +1,45 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# the extractor javascript and the NDJSON lines of --extract
+
+import json
+
+import pytest
+
+from extract_phantompy import SELECTORS_JS, sextract_js, sextractor_js, sndjson
+
+def test_function():
+    sjs = 'function(document) { return document.title; }'
+    assert sextractor_js('  ' + sjs + '\n') == sjs
+
+def test_file(tmp_path):
+    sfile = str(tmp_path / 'extract.js')
+    with open(sfile, 'wt') as ofd:
+        ofd.write('function(document) { return 1; }\n')
+    assert sextractor_js(sfile) == 'function(document) { return 1; }'
+
+def test_selectors():
+    dmap = {'title': 'h1', 'links': ['a@href']}
+    assert sextractor_js(json.dumps(dmap)) == SELECTORS_JS % json.dumps(dmap)
+    for sextract in ['{"title": ', '{"title": 1}', '{"links": ["a", "b"]}',
+                     '{"title": ""}']:
+        with pytest.raises(ValueError):
+            sextractor_js(sextract)
+
+def test_extract_js():
+    sjs = sextract_js('{"title": "h1"}', dict(smode='load'))
+    assert 'window.phantompy_extract' in sjs
+    assert '"load"' in sjs
+    with pytest.raises(ValueError):
+        sextract_js('{"title": "h1"}', dict(smode='never'))
+
+def test_ndjson():
+    d = json.loads(sndjson(dict(uri='http://a/', status='ok',
+                                data={'extract': {'title': 'A'}, 'ready': 'load'})))
+    assert d == dict(uri='http://a/', status='ok', data={'title': 'A'})
+    # the extractor threw
+    d = json.loads(sndjson(dict(uri='http://a/', status='ok',
+                                data={'error': 'boom', 'ready': 'load'})))
+    assert d == dict(uri='http://a/', status='error', error='boom', data=None)
+    d = json.loads(sndjson(dict(uri='http://a/', status='timeout', data=None)))
+    assert d == dict(uri='http://a/', status='timeout', data=None)
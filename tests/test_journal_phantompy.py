@@ -0,0 +1,109 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# the batch Journal on its own
+
+import json
+
+from journal_phantompy import Journal, dhash_outputs, ssha256_file
+
+def swrite(tmp_path, sname, sdata):
+    sfile = str(tmp_path / sname)
+    with open(sfile, 'wt') as ofd:
+        ofd.write(sdata)
+    return sfile
+
+def dresult(suri, sstatus='ok', outputs=None):
+    outputs = outputs or {}
+    sizes = {}
+    for key, sfile in outputs.items():
+        with open(sfile, 'rb') as ifd:
+            sizes[key] = len(ifd.read())
+    return dict(uri=suri, status=sstatus, val=0 if sstatus == 'ok' else 1,
+                outputs=outputs, sizes=sizes, retries=0)
+
+def test_resume(tmp_path):
+    sjournal = str(tmp_path / 'journal.jsonl')
+    shtml = swrite(tmp_path, 'a.html', '<html>a</html>')
+    journal = Journal(sjournal)
+    for suri in ['http://a/', 'http://b/', 'http://c/']:
+        journal.vstart(suri)
+    journal.vfinish(dresult('http://a/', outputs={'html': shtml}),
+                    dhash_outputs({'html': shtml}))
+    journal.vfinish(dresult('http://b/', 'timeout'))
+    # http://c/ never finishes: the run dies
+    journal.close()
+
+    journal = Journal(sjournal)
+    ljobs = [('http://a/', shtml, ''), ('http://b/', '', ''),
+             ('http://c/', '', ''), ('http://d/', '', '')]
+    assert [elt[0] for elt in journal.lpending(ljobs)] == \
+        ['http://b/', 'http://c/', 'http://d/']
+    journal.close()
+
+def test_outputs_changed(tmp_path):
+    sjournal = str(tmp_path / 'journal.jsonl')
+    shtml = swrite(tmp_path, 'a.html', '<html>a</html>')
+    spdf = swrite(tmp_path, 'b.pdf', '%PDF')
+    journal = Journal(sjournal)
+    journal.vfinish(dresult('http://a/', outputs={'html': shtml}))
+    journal.vfinish(dresult('http://b/', outputs={'pdf': spdf}))
+    journal.close()
+    swrite(tmp_path, 'a.html', '<html>truncated')
+    (tmp_path / 'b.pdf').unlink()
+    journal = Journal(sjournal)
+    assert not journal.bdone('http://a/')
+    assert not journal.bdone('http://b/')
+    journal.close()
+
+def test_last_finish_counts(tmp_path):
+    sjournal = str(tmp_path / 'journal.jsonl')
+    journal = Journal(sjournal)
+    journal.vfinish(dresult('http://a/', 'error'))
+    journal.vfinish(dresult('http://a/'))
+    journal.vfinish(dresult('http://b/'))
+    journal.vfinish(dresult('http://b/', 'crashed'))
+    journal.close()
+    journal = Journal(sjournal)
+    assert journal.bdone('http://a/')
+    assert not journal.bdone('http://b/')
+    journal.close()
+
+def test_torn_line(tmp_path):
+    sjournal = str(tmp_path / 'journal.jsonl')
+    journal = Journal(sjournal)
+    journal.vfinish(dresult('http://a/'))
+    journal.close()
+    with open(sjournal, 'at') as ofd:
+        ofd.write('{"event": "finish", "uri": "http://b/", "sta')
+    journal = Journal(sjournal)
+    assert journal.bdone('http://a/')
+    assert not journal.bdone('http://b/')
+    journal.vfinish(dresult('http://b/'))
+    journal.close()
+    # the new line is not run on from the torn one
+    with open(sjournal, 'rt') as ifd:
+        llines = ifd.read().splitlines()
+    assert json.loads(llines[-1])['uri'] == 'http://b/'
+    journal = Journal(sjournal)
+    assert journal.bdone('http://b/')
+    journal.close()
+
+def test_hashes(tmp_path):
+    shtml = swrite(tmp_path, 'a.html', '<html>a</html>')
+    dhashes = dhash_outputs({'html': shtml, 'pdf': str(tmp_path / 'missing.pdf')})
+    assert dhashes == {'html': ssha256_file(shtml)}
+    assert len(dhashes['html']) == 64
+
+def test_data_kept(tmp_path):
+    # an --extract batch prints the skipped urls from their finish
+    sjournal = str(tmp_path / 'journal.jsonl')
+    journal = Journal(sjournal)
+    d = dresult('http://a/')
+    d['data'] = {'extract': {'title': 'A'}, 'ready': 'load'}
+    journal.vfinish(d)
+    journal.close()
+    journal = Journal(sjournal)
+    assert journal.bdone('http://a/')
+    assert journal.dfinished('http://a/')['data'] == d['data']
+    assert journal.dfinished('http://b/') is None
+    journal.close()
@@ -0,0 +1,83 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# lookupdns against the stand-in resolver of bench_phantompy, no browser
+
+import json
+import socket
+
+from pytest import fixture
+
+import lookupdns
+from bench_phantompy import ostart_fixture_server
+
+@fixture(scope="module")
+def server():
+    server = ostart_fixture_server()
+    yield server
+    server.shutdown()
+
+@fixture
+def sresolver(server):
+    return server.sbase + '/resolve'
+
+def sclosed_url():
+    """A url on a port nothing listens on."""
+    with socket.socket() as osock:
+        osock.bind(('127.0.0.1', 0))
+        iport = osock.getsockname()[1]
+    return f"http://127.0.0.1:{iport}/resolve"
+
+def test_tlookfor_fast_good(sresolver):
+    assert lookupdns.tlookfor_fast(lookupdns.surl_for('AAAA', sresolver)) == (0, 300)
+
+def test_tlookfor_fast_bad(sresolver):
+    assert lookupdns.tlookfor_fast(lookupdns.surl_for('bad1', sresolver)) == (2, 300)
+
+def test_tlookfor_fast_nxdomain(sresolver):
+    # no Answer: no verdict, for the TTL of the Authority record
+    assert lookupdns.tlookfor_fast(lookupdns.surl_for('nx1', sresolver)) == (1, 60)
+
+def test_tlookfor_fast_malformed(sresolver):
+    assert lookupdns.tlookfor_fast(lookupdns.surl_for('malformed1', sresolver))[0] == 1
+
+def test_tlookfor_fast_not_json(server):
+    # an html page needs a browser
+    assert lookupdns.tlookfor_fast(lookupdns.surl_for('AAAA', server.sbase + '/static.html')) == (-1, 0)
+
+def test_tlookfor_fast_unreachable():
+    assert lookupdns.tlookfor_fast(lookupdns.surl_for('AAAA', sclosed_url())) == (-1, 0)
+
+def test_dverify(sresolver, tmp_path):
+    sfile = str(tmp_path / 'cache.json')
+    cache = lookupdns.LookupCache(sfile)
+    dresults = lookupdns.dverify(['AAAA', 'bad1', 'nx1', 'malformed1', 'AAAA', ' '],
+                                 'example.org', sresolver, cache, iconcurrency=2)
+    assert sorted(dresults) == ['AAAA', 'bad1', 'malformed1', 'nx1']
+    assert dresults['AAAA'][:2] == (True, 300)
+    assert dresults['bad1'][:2] == (False, 300)
+    assert dresults['nx1'][0] is None
+    assert dresults['malformed1'][0] is None
+    # only the verdicts are kept
+    with open(sfile, 'rt') as ifd:
+        assert sorted(json.load(ifd)) == ['AAAA', 'bad1']
+
+def test_dverify_cached(tmp_path):
+    # cached verdicts are not asked about again
+    cache = lookupdns.LookupCache(str(tmp_path / 'cache.json'))
+    cache.vput('AAAA', (True, 300, lookupdns.time.time()))
+    dresults = lookupdns.dverify(['AAAA'], '', sclosed_url(), cache)
+    assert dresults['AAAA'][0] is True
+
+def test_dverify_unreachable(tmp_path):
+    sfile = str(tmp_path / 'cache.json')
+    cache = lookupdns.LookupCache(sfile)
+    dresults = lookupdns.dverify(['AAAA', 'BBBB'], '', sclosed_url(), cache)
+    assert [elt[0] for elt in dresults.values()] == [None, None]
+    with open(sfile, 'rt') as ifd:
+        assert json.load(ifd) == {}
+
+def test_dverify_rate(sresolver):
+    t0 = lookupdns.time.monotonic()
+    lookupdns.dverify(['AAAA', 'BBBB', 'CCCC'], '', sresolver, frate=20.0)
+    # one at once, then one every 50 ms on the one host
+    assert lookupdns.time.monotonic() - t0 >= 0.09
@@ -0,0 +1,62 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# the Metrics of RenderResult dicts and their export
+
+import json
+import os
+
+from metrics_phantompy import Metrics, vwrite_metrics
+
+def dresult(sstatus='ok', **kw):
+    d = dict(uri='http://a/', status=sstatus, cached=False, retries=0,
+             sizes={'html': 100}, requests={'blocked': {'image': 2}},
+             timings={'start': 0.02, 'load': 0.3, 'exit': 0.4})
+    d.update(kw)
+    return d
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.vobserve(dresult())
+    metrics.vobserve(dresult('timeout', cached=True, retries=1, sizes={},
+                             requests={}, timings={}))
+    lines = metrics.sprometheus().splitlines()
+    assert 'phantompy_jobs_total{status="ok"} 1' in lines
+    assert 'phantompy_jobs_total{status="timeout"} 1' in lines
+    assert 'phantompy_cached_total 1' in lines
+    assert 'phantompy_render_retries_total 1' in lines
+    assert 'phantompy_output_bytes_total{kind="html"} 100' in lines
+    assert 'phantompy_blocked_requests_total{type="image"} 2' in lines
+    assert '# TYPE phantompy_stage_seconds histogram' in lines
+    # the load stage is the time from start to load
+    assert 'phantompy_stage_seconds_bucket{stage="load",le="0.25"} 0' in lines
+    assert 'phantompy_stage_seconds_bucket{stage="load",le="0.5"} 1' in lines
+    assert 'phantompy_stage_seconds_bucket{stage="load",le="+Inf"} 1' in lines
+    assert 'phantompy_job_seconds_count 1' in lines
+    assert 'phantompy_job_seconds_sum 0.4' in lines
+
+def test_snapshot():
+    metrics = Metrics()
+    metrics.vobserve(dresult())
+    d = metrics.dsnapshot()
+    assert d['counters']['phantompy_jobs_total,status=ok'] == 1
+    assert d['histograms']['phantompy_job_seconds']['count'] == 1
+    assert d['histograms']['phantompy_job_seconds']['buckets'][0.5] == 1
+    json.dumps(d)
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.vobserve(dresult())
+    sprom = str(tmp_path / 'metrics.prom')
+    vwrite_metrics(sprom, metrics)
+    vwrite_metrics(sprom, metrics)
+    with open(sprom, 'rt') as ifd:
+        assert ifd.read() == metrics.sprometheus()
+    assert not os.path.exists(sprom + '.tmp')
+    sjsonl = str(tmp_path / 'metrics.jsonl')
+    vwrite_metrics(sjsonl, metrics)
+    metrics.vobserve(dresult('error'))
+    vwrite_metrics(sjsonl, metrics)
+    with open(sjsonl, 'rt') as ifd:
+        lines = [json.loads(line) for line in ifd]
+    assert [len(d['counters']) for d in lines] == [3, 4]
+    assert lines[1]['counters']['phantompy_jobs_total,status=error'] == 1
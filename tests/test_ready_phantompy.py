@@ -0,0 +1,19 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# the ready javascript of each mode
+
+import pytest
+
+from ready_phantompy import lREADY_MODES, sready_js
+
+def test_modes():
+    for smode in lREADY_MODES:
+        sjs = sready_js(smode, itimeout=3000, iidle=200, sselector='#main')
+        assert '3000' in sjs and '200' in sjs
+    assert '"#main"' in sready_js('selector', sselector='#main')
+
+def test_bad_mode():
+    with pytest.raises(ValueError):
+        sready_js('never')
+    with pytest.raises(ValueError):
+        sready_js('selector')
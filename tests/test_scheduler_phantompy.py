@@ -0,0 +1,116 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# the Scheduler on its own: no Qt, just asyncio
+
+import asyncio
+import time
+
+from scheduler_phantompy import Scheduler, shost_of
+
+def test_shost_of():
+    assert shost_of('https://A.Example.org:8443/x') == 'a.example.org'
+    assert shost_of('about:blank') == ''
+
+def test_priority():
+    async def run():
+        sched = Scheduler(iconcurrency=1)
+        lorder = []
+        first = await sched.acquire('http://a/')
+
+        async def job(sname, surl, ipriority):
+            async with sched.oslot(surl, ipriority):
+                lorder.append(sname)
+
+        ltasks = [asyncio.ensure_future(job('low', 'http://a/1', 0)),
+                  asyncio.ensure_future(job('high', 'http://a/2', 5)),
+                  asyncio.ensure_future(job('mid', 'http://a/3', 1))]
+        await asyncio.sleep(0)
+        assert sched.qsize() == 3
+        sched.release(first)
+        await asyncio.gather(*ltasks)
+        return lorder
+    assert asyncio.run(run()) == ['high', 'mid', 'low']
+
+def test_host_concurrency():
+    async def run():
+        sched = Scheduler(iconcurrency=4, ihost_concurrency=1)
+        dinflight = {}
+        dmax = {}
+
+        async def job(surl):
+            async with sched.oslot(surl) as ticket:
+                dinflight[ticket.shost] = dinflight.get(ticket.shost, 0) + 1
+                dmax[ticket.shost] = max(dmax.get(ticket.shost, 0), dinflight[ticket.shost])
+                await asyncio.sleep(0.01)
+                dinflight[ticket.shost] -= 1
+
+        await asyncio.gather(*[job(f"http://{shost}/{i}")
+                               for i in range(4) for shost in ['a', 'b']])
+        return dmax, sched.dstats()
+    dmax, dstats = asyncio.run(run())
+    assert dmax == {'a': 1, 'b': 1}
+    assert dstats['dispatched'] == 8
+    assert dstats['inflight'] == 0 and dstats['queued'] == 0
+
+def test_round_robin():
+    async def run():
+        sched = Scheduler(iconcurrency=1)
+        lorder = []
+        first = await sched.acquire('http://a/0')
+
+        async def job(surl):
+            async with sched.oslot(surl) as ticket:
+                lorder.append(ticket.shost)
+
+        ltasks = [asyncio.ensure_future(job(f"http://a/{i}")) for i in range(3)] + \
+                 [asyncio.ensure_future(job(f"http://b/{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        sched.release(first)
+        await asyncio.gather(*ltasks)
+        return lorder
+    # one host with many jobs does not starve the other
+    assert asyncio.run(run()) == ['b', 'a', 'b', 'a', 'b', 'a']
+
+def test_rate():
+    async def run():
+        sched = Scheduler(iconcurrency=4, frate=20.0, iburst=2)
+        lstarted = []
+
+        async def job(surl):
+            async with sched.oslot(surl):
+                lstarted.append(time.monotonic())
+
+        t0 = time.monotonic()
+        await asyncio.gather(*[job(f"http://a/{i}") for i in range(4)],
+                             job("http://b/0"))
+        return [elt - t0 for elt in sorted(lstarted)]
+    lstarted = asyncio.run(run())
+    # a burst of 2 on a and b at once, then a token every 50 ms on a
+    assert lstarted[3] - lstarted[2] >= 0.04
+    assert lstarted[4] - lstarted[3] >= 0.04
+
+def test_cancel_waiting():
+    async def run():
+        sched = Scheduler(iconcurrency=1)
+        first = await sched.acquire('http://a/')
+        lran = []
+
+        async def job(sname):
+            async with sched.oslot('http://a/' + sname):
+                lran.append(sname)
+
+        cancelled = asyncio.ensure_future(job('cancelled'))
+        other = asyncio.ensure_future(job('other'))
+        await asyncio.sleep(0)
+        assert sched.qsize() == 2
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert sched.qsize() == 1
+        sched.release(first)
+        await other
+        assert cancelled.cancelled()
+        return lran, sched.dstats()
+    lran, dstats = asyncio.run(run())
+    assert lran == ['other']
+    assert dstats['inflight'] == 0 and dstats['queued'] == 0
+    assert dstats['dispatched'] == 2
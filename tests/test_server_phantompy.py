@@ -0,0 +1,43 @@
+# -*- mode: python; indent-tabs-mode: nil; py-indent-offset: 4; coding: utf-8 -*-
+
+# the checks of server jobs against the trust model, which need no Qt
+
+import os
+
+import pytest
+
+from server_phantompy import tjob_paths
+
+def test_paths_in_dir(tmp_path):
+    sdir = os.path.realpath(str(tmp_path))
+    js, html, pdf = tjob_paths(dict(url='https://example.com/', js='a.js',
+                                    html='out/a.html', pdf='-'), sdir)
+    assert js == os.path.join(sdir, 'a.js')
+    assert html == os.path.join(sdir, 'out', 'a.html')
+    assert pdf == '-'
+    for djob in [dict(html='../a.html'), dict(js='/etc/passwd'),
+                 dict(pdf=os.path.join(sdir, '..', 'a.pdf'))]:
+        with pytest.raises(ValueError):
+            tjob_paths(djob, sdir)
+
+def test_file_urls_refused(tmp_path):
+    sdir = os.path.realpath(str(tmp_path))
+    sfile = os.path.join(sdir, 'index.html')
+    with open(sfile, 'wt') as ofd:
+        ofd.write('<html></html>')
+    # even inside sdir, as the page could read any file
+    for surl in ['file://' + sfile, sfile, 'FILE:///etc/passwd']:
+        with pytest.raises(ValueError):
+            tjob_paths(dict(url=surl), sdir)
+    # without sdir the server is trusted with its files
+    assert tjob_paths(dict(url='file://' + sfile, html='/tmp/a.html')) == \
+        ('', '/tmp/a.html', '')
+
+def test_types(tmp_path):
+    sdir = os.path.realpath(str(tmp_path))
+    for djob in [dict(url=1), dict(html=['a.html']), dict(js_contents=None),
+                 dict(ready='load'), dict(block=[]), dict(script='main')]:
+        with pytest.raises(ValueError):
+            tjob_paths(djob, sdir)
+    assert tjob_paths(dict(ready=dict(smode='load'), html_contents='<p>hi</p>'),
+                      sdir) == ('', '', '')